@@ -0,0 +1,158 @@
+# Scenario checks for coagulator behaviour that is easy to break without noticing, such as how requests are dispatched and cached.
+# Each check starts it's own coagulator from this directory on a spare port, connects scripted providers and users to it over websockets, and checks what each of them receives. Only the coagulator's own requirements are needed.
+# Run python checks.py to run every check, or give the names of some to run just those. The exit status is the number of checks that failed.
+
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import traceback
+import websockets
+import websockets.asyncio.client
+
+class coagulator:
+	"""Runs a coagulator with the given configuration lines for the duration of an async with block, whose uri attribute is the address to connect to."""
+	def __init__(self, config = ""):
+		self.config = config
+	async def __aenter__(self):
+		self.directory = tempfile.mkdtemp(prefix = "star_checks_")
+		with open(os.path.join(self.directory, "coagulator.ini"), "w") as f: f.write(self.config + "\n")
+		with socket.socket() as s:
+			s.bind(("127.0.0.1", 0))
+			port = s.getsockname()[1]
+		self.uri = f"ws://127.0.0.1:{port}"
+		self.process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "coagulator.py"), "--authless", "--port", str(port), "--config", os.path.join(self.directory, "coagulator.ini")], cwd = self.directory, stdout = subprocess.DEVNULL)
+		while self.process.poll() is None:
+			try:
+				reader, writer = await asyncio.open_connection("127.0.0.1", port)
+				writer.close()
+				return self
+			except OSError: await asyncio.sleep(0.1)
+		raise RuntimeError("the coagulator exited before it began listening")
+	async def __aexit__(self, *exc):
+		self.process.terminate()
+		self.process.wait()
+
+class scripted_provider:
+	"""A provider offering the given voices that records the text of every request it receives in received. If answer is True it answers each one straight away with audio of the form name|voice|text, with the given extension if any."""
+	def __init__(self, name, voices, window = None, answer = True, extension = None):
+		self.name = name
+		self.voices = voices
+		self.window = window
+		self.answer = answer
+		self.extension = extension
+		self.received = []
+	async def connect(self, uri):
+		self.ws = await websockets.asyncio.client.connect(uri, max_size = None)
+		hello = {"provider": 4, "provider_name": self.name, "voices": self.voices}
+		if self.window: hello["window"] = self.window
+		await self.ws.send(json.dumps(hello))
+		self.task = asyncio.create_task(self.serve())
+		await asyncio.sleep(0.2)
+		return self
+	async def serve(self):
+		try:
+			async for message in self.ws:
+				event = json.loads(message)
+				if "text" not in event: continue
+				self.received.append(event["text"])
+				if not self.answer: continue
+				meta = {"id": event["id"]}
+				if self.extension: meta["extension"] = self.extension
+				meta = json.dumps(meta).encode()
+				await self.ws.send(len(meta).to_bytes(2, "little") + meta + f"{self.name}|{event['voice']}|{event['text']}".encode())
+		except websockets.ConnectionClosed: pass
+
+async def connect_user(uri):
+	ws = await websockets.asyncio.client.connect(uri, max_size = None)
+	await ws.send(json.dumps({"user": 4}))
+	json.loads(await ws.recv())
+	return ws
+
+async def receive_audio(ws, timeout = 3):
+	"""Returns a tuple of the metadata and audio of the next audio the user receives, skipping any other messages, or raises an AssertionError if none arrives in time."""
+	while True:
+		try: message = await asyncio.wait_for(ws.recv(), timeout)
+		except asyncio.TimeoutError: raise AssertionError("no audio arrived")
+		if isinstance(message, str): continue
+		length = int.from_bytes(message[:2], "little")
+		return json.loads(message[2:2 + length]), message[2 + length:]
+
+async def check_busy_provider_does_not_block():
+	"""A provider whose window is full must not hold up a user's lines in voices offered by other, idle providers, and lines in each voice must still be dispatched in order."""
+	async with coagulator() as c:
+		stuck = await scripted_provider("stuck", ["Alpha"], window = 1, answer = False).connect(c.uri)
+		idle = await scripted_provider("idle", ["Beta"], window = 4).connect(c.uri)
+		user = await connect_user(c.uri)
+		await user.send(json.dumps({"user": 4, "request": ["alpha: a1", "alpha: a2", "beta: b1", "beta: b2", "alpha: a3", "beta: b3"]}))
+		audio = [(await receive_audio(user))[1] for i in range(3)]
+		assert audio == [b"idle|Beta|b1", b"idle|Beta|b2", b"idle|Beta|b3"], audio
+		assert stuck.received == ["a1"], stuck.received
+
+async def check_uncompressed_preview_serves_render():
+	"""A preview asks for compressed formats while a render of the same line asks for none, but if the provider returned the preview uncompressed the render must be answered from the cache rather than synthesized again."""
+	async with coagulator() as c:
+		provider = await scripted_provider("plain", ["Alpha"]).connect(c.uri)
+		user = await connect_user(c.uri)
+		await user.send(json.dumps({"user": 4, "request": "alpha: hello", "formats": ["flac"], "priority": 1}))
+		await receive_audio(user)
+		await user.send(json.dumps({"user": 4, "request": "alpha: hello"}))
+		meta, audio = await receive_audio(user)
+		assert audio == b"plain|Alpha|hello" and "extension" not in meta, (meta, audio)
+		assert provider.received == ["hello"], provider.received
+
+async def check_compressed_preview_not_served_to_render():
+	"""Audio a provider compressed for a preview must never be sent to a render of the same line that did not ask for that format."""
+	async with coagulator() as c:
+		provider = await scripted_provider("encoder", ["Alpha"], extension = "flac").connect(c.uri)
+		user = await connect_user(c.uri)
+		await user.send(json.dumps({"user": 4, "request": "alpha: hello", "formats": ["flac"], "priority": 1}))
+		await receive_audio(user)
+		await user.send(json.dumps({"user": 4, "request": "alpha: hello", "formats": ["flac"], "priority": 1}))
+		await receive_audio(user)
+		await user.send(json.dumps({"user": 4, "request": "alpha: hello"}))
+		await receive_audio(user)
+		assert provider.received == ["hello", "hello"], provider.received
+
+async def fetch_metrics(uri):
+	"""Returns the text of the coagulator's /metrics page."""
+	reader, writer = await asyncio.open_connection(*uri[5:].split(":"))
+	writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+	response = await reader.read()
+	writer.close()
+	return response.partition(b"\r\n\r\n")[2].decode()
+
+async def check_aborted_lines_leave_queue():
+	"""Lines a user aborts while they wait behind another user's line on a busy provider must stop counting towards the queued requests gauge straight away."""
+	async with coagulator() as c:
+		stuck = await scripted_provider("stuck", ["Alpha"], window = 1, answer = False).connect(c.uri)
+		other = await connect_user(c.uri)
+		await other.send(json.dumps({"user": 4, "request": ["alpha: a0"]}))
+		await asyncio.sleep(0.2)
+		user = await connect_user(c.uri)
+		await user.send(json.dumps({"user": 4, "request": [f"alpha: a{i}" for i in range(1, 5)]}))
+		await asyncio.sleep(0.3)
+		assert "star_queued_requests{user=\"anonymous\"} 4" in await fetch_metrics(c.uri), "lines were not queued"
+		await user.send(json.dumps({"user": 4, "command": "abort"}))
+		await asyncio.sleep(0.3)
+		metrics = await fetch_metrics(c.uri)
+		assert "star_queued_requests{user=\"anonymous\"} 0" in metrics or "star_queued_requests{" not in metrics, [l for l in metrics.splitlines() if l.startswith("star_queued")]
+
+checks = {name[6:]: function for name, function in list(globals().items()) if name.startswith("check_")}
+
+async def main(names):
+	failures = 0
+	for name in names or checks:
+		try:
+			await checks[name]()
+			print(f"{name}: ok")
+		except Exception:
+			failures += 1
+			print(f"{name}: failed")
+			traceback.print_exc()
+	return failures
+
+if __name__ == "__main__": sys.exit(asyncio.run(main(sys.argv[1:])))
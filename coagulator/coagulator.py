@@ -2,24 +2,360 @@
 
 import asyncio
 import argparse
+import base64
+import bisect
+import collections
 import configobj
+import hashlib
+import io
 import json
 import mimetypes
+import mmap
 import os
 import random
 import re
+import struct
 import sys
 import time
 import traceback
 import urllib.parse
+import wave
 import websockets
+import websockets.asyncio.client
 import websockets.asyncio.server
+import zipfile
 
 def g(): pass #globals
 g.provider_rev = 4
 g.user_rev = 4
 g.next_client_id = 1
 g.next_web_id = 10000000
+g.voices_version = 0
+g.latency_smoothing = 0.2
+
+class speech_request:
+	"""Container class which stores what the coagulator needs to remember about a speech request, from the time it is queued until a provider answers it. The voice attribute keeps the voice as the user typed it, so that it can be resolved again against the providers connected at dispatch time. Identical requests made while this one is pending are attached to it as waiters, tuples of (client, request id) that receive the same result. Request ids in stream_ids asked for audio chunks to be relayed as a provider streams them, those in streamed have been sent the first chunk and receive the rest, and chunks holds the audio streamed so far so that everyone else can be sent the complete clip. If the provider servicing a request disconnects or stops answering, the request is dispatched again under a new id, preferably to a provider not in failed_providers, until it has been retried g.max_retries times. Requests forwarded by peer coagulators carry the ids of the coagulators they have passed through in via, so that they are never forwarded back to one of them. The trace dictionary, which is also sent to providers as part of the meta, collects the times at which the request passed each hop on it's way to a provider and back."""
+	def __init__(self, client, voice, meta, priority = 0):
+		self.client = client
+		self.voice = voice
+		self.meta = meta
+		self.priority = priority
+		self.key = speech_cache_key(voice, meta)
+		self.reply_id = meta["id"]
+		self.waiters = []
+		self.canceled = False
+		self.provider = None
+		self.timestamp = time.time()
+		self.queue_position = 0
+		self.stream_ids = set()
+		self.streamed = set()
+		self.chunks = []
+		self.original_id = meta["id"]
+		self.retries = 0
+		self.failed_providers = set()
+		self.deadline = 0
+		self.via = []
+		self.trace = {"coagulator_receive": self.timestamp}
+		self.meta["trace"] = self.trace
+	def recipients(self):
+		"""Returns a list of (client, request id) tuples for every client waiting on the result of this request."""
+		return [(self.client, self.reply_id)] + self.waiters
+	def detach(self, client, id = None):
+		"""Stops delivering the result of this request to the given client, or only to the given one of it's request ids, handing the request over to another waiting client if there is one. Returns True if nobody is left waiting for the result."""
+		match = lambda waiter: waiter[0] is client and (id is None or waiter[1] == id)
+		self.waiters = [w for w in self.waiters if not match(w)]
+		if match((self.client, self.reply_id)):
+			if not self.waiters: return True
+			self.client, self.reply_id = self.waiters.pop(0)
+		return False
+	def dispatched(self, provider):
+		"""Records that this request is about to be sent to the given provider client."""
+		self.provider = provider
+		self.timestamp = time.time()
+		self.deadline = self.timestamp + g.request_timeout
+		self.trace["coagulator_dispatch"] = self.timestamp
+		if g.request_timeout > 0: self.meta["timeout"] = g.request_timeout
+		self.queue_position = provider["in_flight"]
+		provider["in_flight"] += 1
+		provider["dispatched"].add(self)
+		g.speech_requests[self.meta["id"]] = self
+
+class audio_cache:
+	"""An in memory cache of synthesized audio keyed on everything that determines what a clip sounds like, evicting the least recently used clips once the total size of the audio it holds exceeds max_bytes. A max_bytes of 0 disables caching."""
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.items = collections.OrderedDict()
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+	def get(self, key):
+		"""Returns a tuple of (meta, audio) for a cached clip, or None if the clip is not cached. Meta is a dictionary of the clip's metadata excluding it's id."""
+		if not self.max_bytes: return None
+		item = self.items.get(key)
+		if not item:
+			self.misses += 1
+			return None
+		self.items.move_to_end(key)
+		self.hits += 1
+		return item
+	def put(self, key, meta, audio):
+		"""Adds a clip to the cache, evicting older clips as needed to stay within budget. Clips larger than the entire budget are not cached."""
+		if not self.max_bytes or len(audio) > self.max_bytes: return
+		if key in self.items: self.size -= len(self.items.pop(key)[1])
+		self.items[key] = (meta, audio)
+		self.size += len(audio)
+		while self.size > self.max_bytes:
+			old_key, old_item = self.items.popitem(last = False)
+			self.size -= len(old_item[1])
+			self.evictions += 1
+	def stats(self):
+		"""Returns a dictionary of statistics useful for sizing the cache."""
+		lookups = self.hits + self.misses
+		return {"items": len(self.items), "bytes": self.size, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses, "hit_ratio": self.hits / lookups if lookups else 0.0, "evictions": self.evictions}
+
+class audio_store:
+	"""A persistent, content addressed store of synthesized audio on disk that survives coagulator restarts. Each clip is kept in a file named after the hash of it's cache key, sharded into subdirectories by the hash's first two characters, containing the same 2 byte meta length and json meta header used on the wire followed by the audio. Files are memory mapped when served so that large clips are not read into memory first. The least recently used files are deleted once the store exceeds max_bytes, and files not used for max_age seconds (0 for no limit) are treated as missing."""
+	def __init__(self, path, max_bytes, max_age = 0):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.max_age = max_age
+		self.files = collections.OrderedDict() # digest: (size, last use time), least recently used first.
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		os.makedirs(path, exist_ok = True)
+		entries = []
+		for shard in os.scandir(path):
+			if not shard.is_dir() or len(shard.name) != 2: continue
+			for f in os.scandir(shard.path):
+				if f.name.endswith(".tmp"):
+					os.unlink(f.path)
+					continue
+				st = f.stat()
+				entries.append((st.st_mtime, f.name, st.st_size))
+		for mtime, digest, size in sorted(entries):
+			self.files[digest] = (size, mtime)
+			self.size += size
+		self.evict()
+	@staticmethod
+	def digest(key): return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+	def filename(self, digest): return os.path.join(self.path, digest[:2], digest)
+	def evict(self):
+		"""Deletes the least recently used files until the store is within it's size budget, as well as any that have expired."""
+		now = time.time()
+		while self.files:
+			digest, (size, used) = next(iter(self.files.items()))
+			if self.size <= self.max_bytes and (not self.max_age or now - used < self.max_age): break
+			self.discard(digest)
+			self.evictions += 1
+	def discard(self, digest):
+		size, used = self.files.pop(digest)
+		self.size -= size
+		try: os.unlink(self.filename(digest))
+		except OSError: pass # Probably still mapped by a reader on windows, it will be cleaned up on the next start.
+	def open(self, key):
+		"""Returns a tuple of (meta, map, offset) for a stored clip where the audio data starts at the given offset into the memory mapped file, or None if the clip is not stored. The caller must close the map when it is finished with it."""
+		digest = self.digest(key)
+		if digest not in self.files:
+			self.misses += 1
+			return None
+		if self.max_age and time.time() - self.files[digest][1] >= self.max_age:
+			self.discard(digest)
+			self.misses += 1
+			return None
+		try:
+			with open(self.filename(digest), "rb") as f: clip = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+			meta_len = int.from_bytes(clip[:2], "little")
+			meta = json.loads(clip[2:meta_len + 2])
+		except (OSError, ValueError):
+			self.discard(digest)
+			self.misses += 1
+			return None
+		now = time.time()
+		self.files[digest] = (self.files[digest][0], now)
+		self.files.move_to_end(digest)
+		try: os.utime(self.filename(digest), (now, now))
+		except OSError: pass
+		self.hits += 1
+		return meta, clip, meta_len + 2
+	async def put(self, key, meta, audio):
+		"""Writes a clip to the store on a worker thread if it is not already stored, evicting older clips as needed."""
+		digest = self.digest(key)
+		if not audio or digest in self.files or len(audio) > self.max_bytes: return
+		filename = self.filename(digest)
+		def write():
+			os.makedirs(os.path.dirname(filename), exist_ok = True)
+			with open(filename + ".tmp", "wb") as f: f.writelines(make_audio_frame(meta, audio))
+			os.replace(filename + ".tmp", filename)
+			return os.path.getsize(filename)
+		try: size = await asyncio.to_thread(write)
+		except OSError:
+			traceback.print_exc()
+			return
+		if digest in self.files: return
+		self.files[digest] = (size, time.time())
+		self.size += size
+		self.evict()
+	def stats(self):
+		lookups = self.hits + self.misses
+		return {"items": len(self.files), "bytes": self.size, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses, "hit_ratio": self.hits / lookups if lookups else 0.0, "evictions": self.evictions}
+
+class metrics:
+	"""Counters and histograms describing what the coagulator has been doing, labeled by provider, voice and user and rendered in the Prometheus text format by the /metrics page of the HTTP frontend. Everything is kept in plain dictionaries keyed on a metric name and a tuple of (label, value) pairs, so that instrumenting a busy code path costs only a dictionary update or two."""
+	latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+	descriptions = {
+		"star_requests_total": ("counter", "Lines of speech requested, by user and voice."),
+		"star_coalesced_requests_total": ("counter", "Requests attached to an identical request that was already pending, by user."),
+		"star_unroutable_requests_total": ("counter", "Requests for voices that no provider offered, by user."),
+		"star_aborts_total": ("counter", "Requests canceled before any audio was received, by user."),
+		"star_responses_total": ("counter", "Clips synthesized by providers, by provider and voice."),
+		"star_failures_total": ("counter", "Requests that providers failed to synthesize, by provider, voice and reason."),
+		"star_retries_total": ("counter", "Requests dispatched again after their provider disconnected or timed out, by the failed provider, voice and reason."),
+		"star_audio_received_bytes_total": ("counter", "Bytes of audio received from providers, by provider."),
+		"star_audio_sent_bytes_total": ("counter", "Bytes of audio sent to users, including cache hits, by user."),
+		"star_synthesis_latency_seconds": ("histogram", "Seconds from dispatching a request to a provider until it's audio was complete, by provider and voice."),
+		"star_stage_seconds": ("histogram", "Seconds that traced requests spent in each stage of their journey through the coagulator and provider, by provider and stage."),
+		"star_provider_in_flight": ("gauge", "Requests currently dispatched to each connected provider."),
+		"star_provider_latency_seconds": ("gauge", "Smoothed seconds each connected provider spends per request, as used to balance load."),
+		"star_queued_requests": ("gauge", "Requests waiting in the coagulator for provider capacity, by user."),
+		"star_pending_requests": ("gauge", "Requests dispatched to providers and awaiting audio."),
+		"star_clients": ("gauge", "Connected websocket clients."),
+		"star_voices": ("gauge", "Distinct voices available."),
+		"star_cache_hits_total": ("counter", "Requests answered from the audio cache, by cache."),
+		"star_cache_misses_total": ("counter", "Requests not found in the audio cache, by cache."),
+		"star_cache_evictions_total": ("counter", "Clips evicted from the audio cache, by cache."),
+		"star_cache_items": ("gauge", "Clips held in the audio cache, by cache."),
+		"star_cache_bytes": ("gauge", "Bytes of audio held in the audio cache, by cache."),
+	}
+	def __init__(self):
+		self.counters = collections.defaultdict(float)
+		self.histograms = {}
+	def inc(self, name, labels = (), value = 1):
+		self.counters[(name, labels)] += value
+	def observe(self, name, labels, value):
+		"""Records a sample in a histogram, stored as a list of the count of samples falling in each bucket followed by the sum and count of all samples."""
+		h = self.histograms.get((name, labels))
+		if not h: h = self.histograms[(name, labels)] = [0] * (len(self.latency_buckets) + 3)
+		h[bisect.bisect_left(self.latency_buckets, value)] += 1
+		h[-2] += value
+		h[-1] += 1
+	@staticmethod
+	def format_labels(labels):
+		"""Formats a tuple of (label, value) pairs as a Prometheus label set, escaping the values as the format requires."""
+		if not labels: return ""
+		escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+		return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+	def render(self, gauges = []):
+		"""Returns every metric in the Prometheus text exposition format, along with the given list of (name, labels, value) tuples that are measured at the time of the scrape."""
+		samples = collections.defaultdict(list)
+		for (name, labels), value in list(self.counters.items()) + [((name, labels), value) for name, labels, value in gauges]:
+			samples[name].append(f"{name}{self.format_labels(labels)} {value:g}")
+		for (name, labels), h in self.histograms.items():
+			total = 0
+			for bucket, count in zip(self.latency_buckets + ("+Inf",), h):
+				total += count
+				samples[name].append(f"{name}_bucket{self.format_labels(labels + (('le', bucket),))} {total}")
+			samples[name].append(f"{name}_sum{self.format_labels(labels)} {h[-2]:g}")
+			samples[name].append(f"{name}_count{self.format_labels(labels)} {h[-1]}")
+		lines = []
+		for name in sorted(samples):
+			type, description = self.descriptions.get(name, ("untyped", ""))
+			lines += [f"# HELP {name} {description}", f"# TYPE {name} {type}"] + samples[name]
+		return "\n".join(lines) + "\n"
+
+def metrics_user(client):
+	"""Returns the user label that metrics about a client's requests are recorded under."""
+	return client.get("username") or "anonymous"
+
+def provider_metrics_labels(req):
+	return (("provider", req.provider.get("provider_name", "")), ("voice", req.meta["voice"]))
+
+def trace_stages(trace):
+	"""Works out how long a request spent in each stage of it's journey from the timestamps in it's trace, leaving out any stage that a hop did not record. Every stage is the difference between times taken on the same machine, so clocks that disagree between machines don't matter; the provider_network stage is the round trip between the coagulator and provider less the time the provider spent on the request."""
+	spans = {
+		"coagulator_queue": (("coagulator_dispatch", "coagulator_receive"),),
+		"provider_network": (("coagulator_response", "coagulator_dispatch"), ("provider_receive", "provider_send")),
+		"provider_queue": (("provider_dequeue", "provider_receive"),),
+		"synthesis": (("synthesis_end", "synthesis_start"),),
+		"provider_other": (("provider_send", "provider_receive"), ("provider_dequeue", "provider_receive"), ("synthesis_start", "synthesis_end")),
+	}
+	stages = {}
+	for stage, pairs in spans.items():
+		try: stages[stage] = max(sum(float(trace[a]) - float(trace[b]) for a, b in pairs), 0.0)
+		except (KeyError, TypeError, ValueError): continue
+	return stages
+
+def scrape_metrics():
+	"""Renders the coagulator's metrics, measuring it's current state as gauges."""
+	gauges = []
+	queued = collections.Counter()
+	for (priority, user), queue in g.user_queues.items():
+		queued[user if isinstance(user, str) else "anonymous"] += sum(1 for req in queue if not req.canceled)
+	gauges += [("star_queued_requests", (("user", user),), count) for user, count in queued.items()]
+	for client in g.clients.values():
+		if not client["voices"]: continue
+		labels = (("provider", client.get("provider_name", "")), ("client", client["id"]))
+		gauges.append(("star_provider_in_flight", labels, client["in_flight"]))
+		if "latency" in client: gauges.append(("star_provider_latency_seconds", labels, client["latency"]))
+	gauges += [("star_pending_requests", (), len(g.speech_requests)), ("star_clients", (), len(g.clients)), ("star_voices", (), len(g.voices))]
+	for cache, stats in [("memory", g.audio_cache.stats()), ("disk", g.audio_store.stats() if g.audio_store else None)]:
+		if not stats: continue
+		labels = (("cache", cache),)
+		gauges += [("star_cache_hits_total", labels, stats["hits"]), ("star_cache_misses_total", labels, stats["misses"]), ("star_cache_evictions_total", labels, stats["evictions"]), ("star_cache_items", labels, stats["items"]), ("star_cache_bytes", labels, stats["bytes"])]
+	return g.metrics.render(gauges)
+
+def background(coroutine):
+	"""Runs a coroutine as a task that nothing will await, keeping a reference to it until it finishes so that it is not garbage collected."""
+	task = asyncio.create_task(coroutine)
+	g.background_tasks.add(task)
+	task.add_done_callback(g.background_tasks.discard)
+	return task
+
+async def send_cached_audio(client, id, key, formats = None):
+	"""If audio for the given cache key is available in the memory cache or the disk store, sends it to the client under the given request id and returns True. Audio compressed into one of the given formats is preferred, in their order, to audio that was cached as the provider returned it."""
+	keys = [key + (format,) for format in formats or []] + [key]
+	for key in keys:
+		cached = g.audio_cache.get(key)
+		if cached:
+			await client["ws"].send(make_audio_frame({"id": id, **cached[0]}, cached[1]))
+			g.metrics.inc("star_audio_sent_bytes_total", (("user", metrics_user(client)),), len(cached[1]))
+			return True
+	stored = next(filter(None, (g.audio_store.open(key) for key in keys)), None) if g.audio_store else None
+	if not stored: return False
+	meta, clip, offset = stored
+	meta["id"] = id
+	audio = memoryview(clip)[offset:]
+	try:
+		await client["ws"].send(make_audio_frame(meta, audio))
+		g.metrics.inc("star_audio_sent_bytes_total", (("user", metrics_user(client)),), len(audio))
+	finally:
+		audio.release()
+		clip.close()
+	return True
+
+def speech_cache_key(voice, meta, encoding = None):
+	"""Returns the key that the audio for a speech request is cached under, given the voice as the user typed it and the request's meta after voice resolution. Voices requested from a particular user are cached separately, as that user's voice may differ from others of the same name. Audio that a provider compressed into one of the formats the request asked for is cached under that format as encoding, so that it is only sent to clients that can play it, while everything else is shared by all requests for the line whatever formats they asked for."""
+	user = voice.strip().partition("/")[0] if "/" in voice else ""
+	key = (user, meta["voice"], meta.get("rate"), meta.get("pitch"), meta["text"])
+	return key + (encoding,) if encoding else key
+
+def can_share_result(pending, formats):
+	"""Returns True if a client that can play the given compressed formats could use whatever a pending speech request comes back with, that is if the pending request asked for no format that the client could not play."""
+	return set(pending.meta.get("formats", [])) <= set(formats or [])
+
+def make_audio_frame(meta, audio):
+	"""Composes a binary audio payload from a metadata dictionary and audio data, returned as a list of the header and the audio so that it can be sent as a fragmented websocket message or written out without copying the audio."""
+	meta = json.dumps(meta).encode()
+	return [len(meta).to_bytes(2, "little") + meta, audio]
+
+def parse_audio_frame(message):
+	"""Splits a binary audio payload into it's metadata dictionary and a memoryview of the audio, so that the audio can be relayed and cached without being copied."""
+	meta_len = int.from_bytes(message[:2], "little")
+	meta = message[2:meta_len+2].decode()
+	meta = json.loads(meta) if meta.startswith("{") else {"id": meta}
+	return meta, memoryview(message)[meta_len+2:]
 
 def parse_speech_meta(meta):
 	"""Takes speech metadata such as "Sam" or "Sam<r=4 p=-2>" and returns a dictionary of parsed properties such as voice, rate, and pitch."""
@@ -39,11 +375,69 @@ def parse_speech_meta(meta):
 			continue
 	return result
 
+def voice_tokens(name):
+	"""Returns the set of lowercase word tokens in a voice name, used as the keys of the voice search index."""
+	return set(re.findall(r"\w+", name.lower()))
+
+def register_voice(voice, client):
+	"""Records that the given provider client offers a voice, incrementally updating the voice search indexes. Returns True if the voice was not previously available on the coagulator."""
+	user_voices = g.user_voices.setdefault(client.get("username"), {})
+	if voice not in user_voices: g.voice_resolutions.clear()
+	user_voices.setdefault(voice, []).append(client["id"])
+	client["voices"].add(voice)
+	if voice in g.voices:
+		g.voices[voice].append(client["id"])
+		return False
+	g.voices[voice] = [client["id"]]
+	g.voice_order[voice] = g.next_voice_order
+	g.next_voice_order += 1
+	for t in voice_tokens(voice): g.voice_index.setdefault(t, set()).add(voice)
+	g.voice_resolutions.clear()
+	return True
+
+def unregister_voice(voice, client):
+	"""Removes every registration of a voice by the given provider client from the voice search indexes. Returns True if the voice is no longer available on the coagulator at all."""
+	client["voices"].discard(voice)
+	user_voices = g.user_voices.get(client.get("username"), {})
+	if voice in user_voices:
+		user_voices[voice] = [id for id in user_voices[voice] if id != client["id"]]
+		if not user_voices[voice]:
+			del user_voices[voice]
+			g.voice_resolutions.clear()
+	if voice not in g.voices: return False
+	g.voices[voice] = [id for id in g.voices[voice] if id != client["id"]]
+	if g.voices[voice]: return False
+	del g.voices[voice]
+	del g.voice_order[voice]
+	for t in voice_tokens(voice):
+		g.voice_index[t].discard(voice)
+		if not g.voice_index[t]: del g.voice_index[t]
+	g.voice_resolutions.clear()
+	return True
+
+def resolve_voice(voice, instance = 1, user = None):
+	"""Returns the full name of the instance'th shortest voice containing the given lowercase partial voice name as whole words, optionally only considering voices provided by the given username, or None if no such voice exists. Candidates are narrowed with the word token index before the word boundary regex is applied."""
+	pool = g.user_voices.get(user, {}) if user else g.voices
+	tokens = voice_tokens(voice)
+	if tokens:
+		matches = sorted((g.voice_index.get(t, set()) for t in tokens), key = len)
+		candidates = matches[0].intersection(*matches[1:])
+	else: candidates = pool
+	try: pattern = re.compile(r"\b" + voice + r"\b")
+	except re.error: return None
+	found = 1
+	for v in sorted([v for v in candidates if v in pool], key = lambda v: (len(v), g.voice_order[v])):
+		if not pattern.search(v.lower()): continue
+		if instance == found: return v
+		found += 1
+	return None
+
 def find_provider_for_voice(voice):
-	"""Searches the list of voices for a provider to send a speech request to given a voice name."""
-	if not voice:
+	"""Searches the list of voices for the full name of a voice given a partial one, returning a tuple of the full voice name and a list of the IDs of the provider clients offering it (None if no voice matched)."""
+	if not voice or not voice.strip():
 		return voice, None
 	voice = voice.strip()
+	if voice in g.voices: return voice, g.voices[voice]
 	user = None
 	if "/" in voice: user, delim, voice = voice.partition("/")
 	voice = voice.lower()
@@ -51,21 +445,187 @@ def find_provider_for_voice(voice):
 	if voice[0].isdigit() and "." in voice:
 		instance, delim, voice = voice.partition(".")
 		instance = int(instance)
-	found = 1
-	for v in sorted(g.voices, key=len):
-		choices = list(g.voices[v])
-		for c in list(choices):
-			if user and getattr(g.clients[c]["ws"], "username") != user: choices.remove(c)
-		if len(choices) < 1: continue
-		if re.search(r"\b" + voice + r"\b", v.lower()):
-			if instance == found:
-				return v, random.choice(choices)
+	key = (user, instance, voice)
+	if key in g.voice_resolutions: v = g.voice_resolutions[key]
+	else:
+		if len(g.voice_resolutions) >= 65536: g.voice_resolutions.clear()
+		v = g.voice_resolutions[key] = resolve_voice(voice, instance, user)
+	if v is None: return voice, None
+	return v, g.user_voices[user][v] if user else g.voices[v]
+
+def pick_provider(choices, priority = 0, voice = None):
+	"""Given a list of provider client IDs that offer a voice, returns the one expected to complete a new request soonest based on its outstanding requests and smoothed per-request latency, breaking ties randomly. Providers directly connected to this coagulator are preferred over peer coagulators, and nearer peers over those that reach the voice through further coagulators. Providers whose request window (as advertised in their hello, or else g.provider_window) is full are skipped, and None is returned if that leaves nothing. Prioritized requests may use up to twice the usual window, as the provider will run them ahead of the bulk work already filling it."""
+	factor = 2 if priority > 0 else 1
+	choices = [c for c in set(choices) if g.clients[c]["in_flight"] < factor * g.clients[c]["window"]]
+	if len(choices) < 2: return choices[0] if choices else None
+	random.shuffle(choices)
+	known = [g.clients[c]["latency"] for c in choices if "latency" in g.clients[c]]
+	default_latency = min(known) if known else 1.0
+	return min(choices, key = lambda c: (g.clients[c].get("voice_hops", {}).get(voice, 0), (g.clients[c]["in_flight"] + 1) * g.clients[c].get("latency", default_latency)))
+
+def record_provider_latency(req):
+	"""Folds the time a provider took to answer a speech request into its smoothed latency. The elapsed time is divided by the number of requests that were outstanding on the provider when this one was dispatched, yielding the effective time the provider spends per request."""
+	sample = (time.time() - req.timestamp) / (req.queue_position + 1)
+	if "latency" in req.provider: req.provider["latency"] += g.latency_smoothing * (sample - req.provider["latency"])
+	else: req.provider["latency"] = sample
+
+def forget_speech_request(req):
+	"""Removes a speech request from the table of pending requests and from the outstanding requests of every client waiting on it, so that new identical requests are no longer attached to it."""
+	for client, id in req.recipients(): client["requests"].discard(req)
+	if g.requests_by_key.get(req.key) is req: del g.requests_by_key[req.key]
+
+def pop_speech_request(id):
+	"""Removes a speech request that has been dispatched, releasing its slot on the provider that was servicing it. Returns the removed request or None."""
+	req = g.speech_requests.pop(id, None)
+	if req:
+		req.provider["in_flight"] -= 1
+		req.provider["dispatched"].discard(req)
+		forget_speech_request(req)
+		g.dispatch_event.set()
+	return req
+
+async def relay(req, make_message):
+	"""Sends a message about a speech request to every client waiting for it's result. make_message is called with each recipient's request id and should return the payload to send them, or None to skip that recipient."""
+	for client, id in req.recipients():
+		message = make_message(id)
+		if message is None: continue
+		try: await client["ws"].send(message)
+		except websockets.ConnectionClosed: pass
+
+async def relay_audio_chunk(req, message, meta, audio):
+	"""Relays a partial audio frame streamed by a provider to the clients that asked for streaming, unbuffered, and holds onto it so that the complete clip can be assembled once the final chunk arrives. Clients that attached to the request after it's first chunk was relayed receive the complete clip instead."""
+	req.chunks.append(audio)
+	if meta["chunk"] == 0: req.streamed = {id for client, id in req.recipients() if id in req.stream_ids}
+	await relay(req, lambda reply_id: None if reply_id not in req.streamed else message if reply_id == meta["id"] else make_audio_frame({**meta, "id": reply_id}, audio))
+
+def queue_key(client):
+	"""Returns the key that a client's speech requests are fairly queued under, their username if they have one or else their client ID."""
+	return client.get("username") or client["id"]
+
+def queue_speech_request(req, front = False):
+	"""Adds a speech request to the end of it's user's dispatch queue for the request's priority, or to the front if it is being retried."""
+	key = (req.priority, queue_key(req.client))
+	if key not in g.user_queues:
+		g.user_queues[key] = collections.deque()
+		g.dispatch_order.append(key)
+	if front: g.user_queues[key].appendleft(req)
+	else: g.user_queues[key].append(req)
+	req.client["requests"].add(req)
+	g.requests_by_key[req.key] = req
+
+async def fail_speech_request(req, reason):
+	"""Handles a dispatched speech request that it's provider will not be answering, either because the provider disconnected or because it took longer than g.request_timeout. The request is queued again at the front of it's user's queue under a new id so that a late answer from the failed provider is ignored, unless it has already been retried g.max_retries times in which case it's clients are warned."""
+	provider = req.provider
+	labels = provider_metrics_labels(req) + (("reason", reason),)
+	pop_speech_request(req.meta["id"])
+	g.metrics.inc("star_failures_total", labels)
+	if req.retries >= g.max_retries:
+		await relay(req, lambda id: json.dumps({"warning": f"provider servicing request {id} {'disappeared' if reason == 'disconnect' else 'timed out'}", "request_id": id}))
+		return
+	req.retries += 1
+	req.failed_providers.add(provider["id"])
+	req.provider = None
+	req.chunks = []
+	req.streamed = set()
+	req.meta["id"] = f"{req.original_id}.{req.retries}"
+	for client, id in req.waiters: client["requests"].add(req)
+	if req.key not in g.requests_by_key: g.requests_by_key[req.key] = req
+	queue_speech_request(req, True)
+	g.metrics.inc("star_retries_total", labels)
+	g.dispatch_event.set()
+
+async def request_reaper():
+	"""Runs for the life of the coagulator, periodically failing over dispatched speech requests whose provider has gone quiet for longer than g.request_timeout. The provider is told to abort the request in case it is merely slow. As other requests may be answered or failed over while earlier ones are handled, each is checked again just before it is failed."""
+	while True:
+		await asyncio.sleep(min(g.request_timeout / 4, 5))
+		now = time.time()
+		expired = lambda req: g.speech_requests.get(req.meta["id"]) is req and req.provider and req.deadline < now
+		for req in [r for r in g.speech_requests.values() if r.deadline < now]:
+			try:
+				if not expired(req): continue
+				try: await req.provider["ws"].send(json.dumps({"abort": req.meta["id"]}))
+				except websockets.ConnectionClosed: pass
+				if expired(req): await fail_speech_request(req, "timeout")
+			except Exception: traceback.print_exc()
+
+async def cancel_speech_request(req, client, id = None):
+	"""Stops delivering the result of a speech request to the given client, or only to the given one of it's request ids, canceling the request if no other client is waiting on it. Canceled requests that are still queued are dropped by the dispatcher, which is woken to do so, while providers are told to abort those they have already received."""
+	if not req.detach(client, id): return
+	req.canceled = True
+	g.metrics.inc("star_aborts_total", (("user", metrics_user(client)),))
+	forget_speech_request(req)
+	if not req.provider:
+		g.dispatch_event.set() # Lets the dispatcher drop it from it's queue now, rather than whenever something else wakes it.
+		return
+	pop_speech_request(req.meta["id"])
+	try: await req.provider["ws"].send(json.dumps({"abort": req.meta["id"]}))
+	except websockets.ConnectionClosed: pass
+
+async def abort_speech_requests(client):
+	"""Stops delivering the results of all speech requests to the given client, canceling any that no other client is waiting on."""
+	for req in list(client["requests"]):
+		client["requests"].discard(req)
+		await cancel_speech_request(req, client)
+
+async def dispatch_speech_requests():
+	"""Releases queued speech requests to providers with free capacity. Users are served with deficit round robin weighted by the length of each line's text, so one user's large render only soaks up provider capacity that nobody else is asking for. Each user's requests are dispatched in the order they were made, and users are visited least recently served first. Queues of prioritized requests, such as previews, are visited before those of bulk renders. Lines whose voice has no provider with room in it's window are held back, along with every later line in the same voice so that each voice's lines still go out in order, while up to g.dispatch_lookahead held lines are skipped over to reach lines in voices whose providers are free."""
+	progress = True
+	while progress and g.dispatch_order:
+		progress = False
+		for key in sorted(g.dispatch_order, key = lambda k: -k[0]):
+			queue = g.user_queues[key]
+			served = False
+			g.deficits[key] = g.deficits.get(key, 0) + g.dispatch_quantum
+			held = []
+			blocked = set()
+			while queue and len(held) < g.dispatch_lookahead:
+				req = queue[0]
+				if req.canceled:
+					queue.popleft()
+					continue
+				cost = len(req.meta["text"])
+				if cost > g.deficits[key]:
+					progress = True
+					break
+				req.meta["voice"], choices = find_provider_for_voice(req.voice)
+				if choices and req.via: choices = [c for c in choices if g.clients[c].get("peer") not in req.via]
+				if choices and req.failed_providers: choices = [c for c in choices if c not in req.failed_providers] or choices
+				provider = pick_provider(choices, req.priority, req.meta["voice"]) if choices and req.meta["voice"] not in blocked else None
+				if choices and provider is None:
+					blocked.add(req.meta["voice"])
+					held.append(queue.popleft())
+					continue
+				queue.popleft()
+				g.deficits[key] -= cost
+				progress = served = True
+				if not choices:
+					g.metrics.inc("star_unroutable_requests_total", (("user", metrics_user(req.client)),))
+					forget_speech_request(req)
+					await relay(req, lambda id: json.dumps({"warning": f"failed to find provider for {req.meta['voice']}", "request_id": id}))
+					continue
+				req.dispatched(g.clients[provider])
+				try: await req.provider["ws"].send(json.dumps({**req.meta, "via": req.via + [g.coagulator_id]} if "peer" in req.provider else req.meta))
+				except websockets.ConnectionClosed: pass
+			if held:
+				queue.extendleft(reversed(held))
+				if not served: g.deficits[key] = min(g.deficits[key], max(g.dispatch_quantum, len(held[0].meta["text"])))
+			if queue and not served: continue
+			g.dispatch_order.remove(key)
+			if queue: g.dispatch_order.append(key)
 			else:
-				found += 1
-	return voice, None
+				del g.user_queues[key]
+				del g.deficits[key]
 
-async def handle_speech_request(client, request, id=""):
-	"""Processes and dispatches each speech request line to the appropriate voice provider."""
+async def dispatcher():
+	"""Runs for the lifetime of the coagulator, dispatching queued speech requests whenever new ones arrive or provider capacity frees up."""
+	while True:
+		await g.dispatch_event.wait()
+		g.dispatch_event.clear()
+		try: await dispatch_speech_requests()
+		except Exception: traceback.print_exc()
+
+async def handle_speech_request(client, request, id="", priority = 0, stream = False, formats = None):
+	"""Processes each speech request line and queues it for dispatch to the appropriate voice provider. Requests with a priority above 0 are interactive and jump ahead of bulk work, both here and on the provider. If stream is True, audio is relayed in chunks as the provider synthesizes it when the provider supports that. formats is an optional list of compressed audio formats the client can play in order of preference, which providers may encode wav audio to."""
 	if "speech_sequence" not in client or id:
 		client["speech_sequence"] = 0
 	if id:
@@ -81,26 +641,64 @@ async def handle_speech_request(client, request, id=""):
 		if "voice" not in meta:
 			await client["ws"].send(json.dumps({"warning": f"failed to parse voice meta {raw_meta}"}))
 			continue
-		meta["voice"], provider = find_provider_for_voice(meta["voice"])
-		if not provider:
+		voice = meta["voice"]
+		meta["voice"], choices = find_provider_for_voice(voice)
+		if not choices:
+			g.metrics.inc("star_unroutable_requests_total", (("user", metrics_user(client)),))
 			await client["ws"].send(json.dumps({"warning": f"failed to find provider for {meta['voice']}"}))
 			continue
-		provider = g.clients[provider]["ws"]
+		g.metrics.inc("star_requests_total", (("user", metrics_user(client)), ("voice", meta["voice"])))
 		client["speech_sequence"] += 1
 		meta.update({"text": text, "id": f"{client['id']}{id}_{client['speech_sequence']}"})
-		await provider.send(json.dumps(meta))
-		g.speech_requests[meta["id"]] = (client, provider)
+		if formats: meta["formats"] = formats
+		key = speech_cache_key(voice, meta)
+		if await send_cached_audio(client, meta["id"], key, formats): continue
+		pending = g.requests_by_key.get(key)
+		if pending and can_share_result(pending, formats) and (pending.provider or pending.priority >= priority):
+			pending.waiters.append((client, meta["id"]))
+			client["requests"].add(pending)
+			g.metrics.inc("star_coalesced_requests_total", (("user", metrics_user(client)),))
+			if stream: pending.stream_ids.add(meta["id"])
+			continue
+		if priority > 0: meta["priority"] = priority
+		if stream: meta["stream"] = True
+		req = speech_request(client, voice, meta, priority)
+		if stream: req.stream_ids.add(meta["id"])
+		queue_speech_request(req)
+	g.dispatch_event.set()
 
 async def on_message(ws, client, message):
 	"""Handles incoming WebSocket messages."""
 	if isinstance(message, bytes):
-		meta_len = int.from_bytes(message[:2], "little")
-		meta = message[2:meta_len+2].decode()
-		if meta.startswith("{"): meta = json.loads(meta)
-		else: meta = {"id": meta}
-		if meta["id"] in g.speech_requests: 
-			await g.speech_requests[meta["id"]][0]["ws"].send(message)
-			del g.speech_requests[meta["id"]]
+		meta, audio = parse_audio_frame(message)
+		if "chunk" in meta:
+			req = g.speech_requests.get(meta["id"])
+			if not req: return
+			req.deadline = time.time() + g.request_timeout
+			g.metrics.inc("star_audio_received_bytes_total", (("provider", client.get("provider_name", "")),), len(audio))
+			await relay_audio_chunk(req, message, meta, audio)
+			if not meta.get("final"): return
+			pop_speech_request(meta["id"])
+			audio = b"".join(req.chunks)
+			del meta["chunk"], meta["final"]
+		else:
+			req = pop_speech_request(meta["id"])
+			g.metrics.inc("star_audio_received_bytes_total", (("provider", client.get("provider_name", "")),), len(audio))
+		if req:
+			record_provider_latency(req)
+			labels = provider_metrics_labels(req)
+			g.metrics.inc("star_responses_total", labels)
+			g.metrics.observe("star_synthesis_latency_seconds", labels, time.time() - req.timestamp)
+			meta["trace"] = {**(meta["trace"] if isinstance(meta.get("trace"), dict) else {}), **req.trace, "coagulator_response": time.time()}
+			for stage, seconds in trace_stages(meta["trace"]).items(): g.metrics.observe("star_stage_seconds", (labels[0], ("stage", stage)), seconds)
+			for recipient, reply_id in req.recipients(): g.metrics.inc("star_audio_sent_bytes_total", (("user", metrics_user(recipient)),), len(audio))
+			key = speech_cache_key(req.voice, req.meta, meta.get("extension") if meta.get("extension") in req.meta.get("formats", []) else None)
+			meta.pop("id")
+			meta["trace"]["coagulator_relay"] = time.time()
+			await relay(req, lambda reply_id: None if reply_id in req.streamed else make_audio_frame({"id": reply_id, **meta}, audio))
+			del meta["trace"]
+			g.audio_cache.put(key, meta, audio)
+			if g.audio_store: background(g.audio_store.put(key, meta, audio))
 		return
 	try:
 		msg = json.loads(message)
@@ -110,74 +708,174 @@ async def on_message(ws, client, message):
 		if msg["provider"] < g.provider_rev:
 			await ws.send(json.dumps({"error": f"must be revision {g.provider_rev} or higher"}))
 			return
-		gained_voice = False
-		for v in msg["voices"]:
-			if v in g.voices:
-				g.voices[v].append(client["id"])
-			else:
-				g.voices[v] = [client["id"]]
-				gained_voice = True
-		if gained_voice:
-			await notify_all_clients({"voices": list(g.voices)}, [client["id"]])
+		client["provider_name"] = str(msg.get("provider_name", ""))
+		try: client["window"] = min(max(int(msg.get("window", g.provider_window)), 1), g.max_provider_window)
+		except (TypeError, ValueError): client["window"] = g.provider_window
+		gained_voices = [v for v in msg["voices"] if register_voice(v, client)]
+		g.dispatch_event.set()
+		if gained_voices: await notify_voice_changes(gained_voices, [], [client["id"]])
+		if client["voices"]: await advertise_to_peers()
+	elif "provider" in msg and "window" in msg and "window" in client and "status" not in msg:
+		try: client["window"] = min(max(int(msg["window"]), 1), g.max_provider_window)
+		except (TypeError, ValueError): return
+		g.dispatch_event.set()
+	elif "peer" in msg:
+		await handle_peer_advertisement(client, msg)
+	elif "peer" in client and "voice" in msg and "text" in msg and "id" in msg:
+		await handle_peer_request(client, msg)
+	elif "peer" in client and "abort" in msg and "status" not in msg:
+		for req in [r for r in client["requests"] if (client, msg["abort"]) in r.recipients()]:
+			await cancel_speech_request(req, client, msg["abort"])
+			if not any(c is client for c, id in req.recipients()): client["requests"].discard(req)
+	elif "peer" in client and "request_id" in msg and msg["request_id"] in g.speech_requests:
+		req = g.speech_requests[msg["request_id"]]
+		if req.provider is client: await fail_speech_request(req, "error")
+	elif "peer" in client and msg.get("looped") and msg.get("id") in g.speech_requests:
+		req = g.speech_requests[msg["id"]]
+		if req.provider is client: await fail_speech_request(req, "error")
 	elif "provider" in msg and "status" in msg and "id" in msg and msg["id"] in g.speech_requests:
-		await g.speech_requests[msg["id"]][0]["ws"].send(message)
-		if "abort" in msg and msg["abort"]: del g.speech_requests[msg["id"]]
+		req = pop_speech_request(msg["id"]) if "abort" in msg and msg["abort"] else g.speech_requests[msg["id"]]
+		if "abort" in msg and msg["abort"]: g.metrics.inc("star_failures_total", provider_metrics_labels(req) + (("reason", "error"),))
+		else: req.deadline = time.time() + g.request_timeout
+		await relay(req, lambda id: message if id == msg["id"] else json.dumps({**msg, "id": id}))
 	elif "user" in msg:
 		if msg["user"] < g.user_rev:
 			await ws.send(json.dumps({"error": f"must be revision {g.user_rev} or higher"}))
 			return
+		client.setdefault("voice_deltas", False)
 		if "request" in msg:
-			await handle_speech_request(client, msg["request"], str(msg.get("id", "")))
+			try: priority = int(msg.get("priority", 0))
+			except (TypeError, ValueError): priority = 0
+			formats = msg.get("formats")
+			formats = [str(f) for f in formats][:8] if isinstance(formats, list) else None
+			await handle_speech_request(client, msg["request"], str(msg.get("id", "")), priority, bool(msg.get("stream", False)), formats)
 		elif "command" in msg:
-			if msg["command"] == "abort":
-				for req_id in list(g.speech_requests):
-					req = g.speech_requests[req_id]
-					if req[0]["ws"] == ws:
-						await req[1].send(json.dumps({"abort": req_id}))
-						del(g.speech_requests[req_id])
+			if msg["command"] == "abort": await abort_speech_requests(client)
 		else:
-			await ws.send(json.dumps({"voices": list(g.voices)}))
+			client["voice_deltas"] = bool(msg.get("voice_deltas", False))
+			await ws.send(json.dumps({"voices": list(g.voices), "version": g.voices_version}))
+
+async def notify_all_clients(data, ignore_list = [], filter = None):
+	"""Broadcasts a message to all connected clients, or only those for which filter returns True if it is given. The message is serialized once no matter how many clients receive it."""
+	clients = [client for client in g.clients.values() if not client["id"] in ignore_list and (not filter or filter(client))]
+	if not clients: return
+	message = json.dumps(data)
+	await asyncio.gather(*[client["ws"].send(message) for client in clients], return_exceptions = True)
+
+async def notify_voice_changes(added, removed, ignore_list = []):
+	"""Tells user clients that voices have been added to or removed from the coagulator, bumping the version of the voice list. Clients that asked for voice deltas in their hello receive just the changes and the new version, so that they can request a full list if they notice that they missed an update, while older clients receive the full list."""
+	g.voices_version += 1
+	delta = {"version": g.voices_version}
+	if added: delta["voices_added"] = added
+	if removed: delta["voices_removed"] = removed
+	await notify_all_clients(delta, ignore_list, lambda client: client.get("voice_deltas"))
+	await notify_all_clients({"voices": list(g.voices), "version": g.voices_version}, ignore_list, lambda client: client.get("voice_deltas") is False)
+
+async def handle_peer_advertisement(client, msg):
+	"""Applies a change to the voices that a peer coagulator can reach, as sent by advertise_voices on the other end of a peer link, and passes the news on to users and the rest of our peers. The first advertisement received over a link identifies the peer and is answered with our own."""
+	if msg["peer"] == g.coagulator_id:
+		await client["ws"].close()
+		return
+	client["peer"] = str(msg["peer"])
+	client["provider_name"] = f"coagulator {client['peer']}"
+	client["window"] = g.peer_window
+	client.setdefault("advertised", None)
+	hops = client.setdefault("voice_hops", {})
+	gained_voices, lost_voices = [], []
+	for voice, distance in dict(msg.get("voices_added", {})).items():
+		try: hops[voice] = int(distance) + 1
+		except (TypeError, ValueError): continue
+		if voice not in client["voices"] and register_voice(voice, client): gained_voices.append(voice)
+	for voice in msg.get("voices_removed", []):
+		hops.pop(voice, None)
+		if voice in client["voices"] and unregister_voice(voice, client): lost_voices.append(voice)
+	g.dispatch_event.set()
+	if gained_voices or lost_voices: await notify_voice_changes(gained_voices, lost_voices, [client["id"]])
+	if msg.get("voices_added") or msg.get("voices_removed"): await advertise_to_peers()
+	elif client["advertised"] is None: await advertise_voices(client)
+
+async def advertise_voices(link):
+	"""Tells a peer coagulator about changes to the voices it can reach through this one since the last advertisement sent over the link, along with how many coagulators away each voice is offered. The first advertisement sent over a link is sent even if empty, so that the peer learns our coagulator ID. Voices are never advertised back to the peer they were learned from, nor to peers that would be more than g.max_hops coagulators away from the voice's provider, so routes can't chase each other in circles."""
+	table = {}
+	for voice, ids in g.voices.items():
+		hops = [g.clients[c].get("voice_hops", {}).get(voice, 0) for c in ids if c != link["id"] and c in g.clients and ("peer" not in g.clients[c] or g.clients[c]["peer"] != link.get("peer"))]
+		if hops and min(hops) < g.max_hops: table[voice] = min(hops)
+	previous = link["advertised"] or {}
+	added = {voice: hops for voice, hops in table.items() if previous.get(voice) != hops}
+	removed = [voice for voice in previous if voice not in table]
+	if not added and not removed and link["advertised"] is not None: return
+	link["advertised"] = table
+	try: await link["ws"].send(json.dumps({"peer": g.coagulator_id, "voices_added": added, "voices_removed": removed}))
+	except websockets.ConnectionClosed: pass
 
-async def notify_all_clients(data, ignore_list = []):
-	"""Broadcasts a message to all connected clients."""
-	if g.clients:
-		await asyncio.gather(*[client["ws"].send(json.dumps(data)) for client in g.clients.values() if not client["id"] in ignore_list])
+async def advertise_to_peers():
+	"""Sends every connected peer coagulator any changes to the voices it can reach through this one."""
+	for client in list(g.clients.values()):
+		if "advertised" in client: await advertise_voices(client)
 
-async def on_client_disconnect(ws, client_id):
+async def handle_peer_request(client, event):
+	"""Handles a speech request forwarded by a peer coagulator, which arrives in the same form as those sent to providers. The request is queued like any other under a local id, with it's results relayed back under the id the peer gave it. Requests that have already passed through this coagulator or through g.max_hops coagulators are refused with a looped key, so that they can never loop and the peer that sent them fails them over straight away."""
+	via = [str(v) for v in event.get("via", [])]
+	if g.coagulator_id in via or len(via) > g.max_hops:
+		await client["ws"].send(json.dumps({"provider": g.provider_rev, "id": event["id"], "status": "request looped between coagulators", "abort": True, "looped": True}))
+		return
+	try: priority = int(event.get("priority", 0))
+	except (TypeError, ValueError): priority = 0
+	stream = bool(event.get("stream", False))
+	meta = {k: event[k] for k in ("voice", "rate", "pitch", "text", "formats") if k in event}
+	if "formats" in meta: meta["formats"] = [str(f) for f in meta["formats"]][:8] if isinstance(meta["formats"], list) else None
+	if not meta.get("formats"): meta.pop("formats", None)
+	meta["voice"] = str(meta["voice"])
+	meta["id"] = f"{client['id']}>{event['id']}"
+	if priority > 0: meta["priority"] = priority
+	if stream: meta["stream"] = True
+	g.metrics.inc("star_requests_total", (("user", metrics_user(client)), ("voice", meta["voice"])))
+	key = speech_cache_key(meta["voice"], meta)
+	if await send_cached_audio(client, event["id"], key, meta.get("formats")): return
+	pending = g.requests_by_key.get(key)
+	if pending and can_share_result(pending, meta.get("formats")) and (pending.provider or pending.priority >= priority):
+		pending.waiters.append((client, event["id"]))
+		client["requests"].add(pending)
+		g.metrics.inc("star_coalesced_requests_total", (("user", metrics_user(client)),))
+		if stream: pending.stream_ids.add(event["id"])
+		return
+	req = speech_request(client, meta["voice"], meta, priority)
+	req.reply_id = event["id"]
+	req.via = via
+	if stream: req.stream_ids.add(event["id"])
+	queue_speech_request(req)
+	g.dispatch_event.set()
+
+async def on_client_disconnect(ws, client):
 	"""Handles client disconnections, updating voice providers and speech requests as needed."""
+	client_id = client["id"]
 	try:
-		lost_voice = False
-		for v in list(g.voices):
-			if client_id in g.voices[v]:
-				while client_id in g.voices[v]: g.voices[v].remove(client_id)
-				if len(g.voices[v]) < 1:
-					del g.voices[v]
-					lost_voice = True
-		if lost_voice: await notify_all_clients({"voices": list(g.voices)}, [client_id])
-		for r in list(g.speech_requests):
-			if g.speech_requests[r][1] == ws:
-				await g.speech_requests[r][0]["ws"].send(json.dumps({"warning": f"provider servicing request {r} disappeared", "request_id": r}))
-			if g.speech_requests[r][0]["ws"] == ws or g.speech_requests[r][1] == ws:
-				del g.speech_requests[r]
+		had_voices = bool(client["voices"])
+		lost_voices = [v for v in list(client["voices"]) if unregister_voice(v, client)]
+		await abort_speech_requests(client)
+		if lost_voices: await notify_voice_changes([], lost_voices, [client_id])
+		if had_voices or "peer" in client: await advertise_to_peers()
+		for req in list(client["dispatched"]): await fail_speech_request(req, "disconnect")
 	except websockets.exceptions.ConnectionClosedOK: pass
 
 class web_send:
-	"""Helper class for STAR's tiny frontend API that allows it to be able to work with existing infrastructure."""
-	def __init__(self, connection): self.connection = connection
+	"""Helper class for STAR's tiny frontend API that allows it to be able to work with existing infrastructure. The response attribute is a future that is resolved with a tuple of (http status, mime type, file extension, body) once the first conclusive message for the request is sent."""
+	def __init__(self, connection):
+		self.connection = connection
+		self.response = asyncio.get_running_loop().create_future()
 	async def __call__(self, message):
 		"""So that the little HTTP API can be added without altering most of the coagulator's code, we just monkeypatch the connection.send method in the below connection_request_handler function so that the existing infrastructure just continues to work. This is the patched send function."""
+		if self.response.done(): return
+		if isinstance(message, list): message = b"".join(message)
 		if isinstance(message, str):
-			self.connection.response_mime = "application/json"
-			self.connection.response_extension = ""
-			self.connection.response = message
+			msg = json.loads(message)
+			if "status" in msg and not msg.get("abort"): return # Just a progress message from the provider.
+			# Provider failures and providers that vanished are the server's problem, otherwise the request itself was bad.
+			self.response.set_result((503 if "status" in msg or "request_id" in msg else 400, "application/json", "", message))
 		elif isinstance(message, bytes):
-			meta_len = int.from_bytes(message[:2], "little")
-			meta = message[2:meta_len+2].decode()
-			if meta.startswith("{"): meta = json.loads(meta)
-			else: meta = {"id": meta}
-			self.connection.response_extension = meta.get("extension", "wav")
-			self.connection.response_mime = mimetypes.guess_type(f"synthesized.{self.connection.response_extension}")[0]
-			self.connection.response = audio = message[meta_len + 2:]
+			meta, audio = parse_audio_frame(message)
+			extension = meta.get("extension", "wav")
+			self.response.set_result((200, mimetypes.guess_type(f"synthesized.{extension}")[0], extension, audio))
 def make_http_response(connection, status, mime, body):
 	"""The websockets API for http headers is a bit bulky, we need a helper function to set up a response that may be either text or binary."""
 	if isinstance(body, str): body = body.encode()
@@ -199,11 +897,12 @@ async def connection_request_handler(connection, request):
 		with open(os.path.join(os.path.dirname(__file__), "coagulator_index.html"), "r") as f: webpage = f.read().replace("{{username}}", getattr(connection, "username", "visitor")).replace("{{voicecount}}", str(len(g.voices)))
 		return make_http_response(connection, 200, "text/html", webpage)
 	elif path == "/voices": return make_http_response(connection, 200, "application/json", json.dumps({"voices": list(g.voices)}))
+	elif path == "/metrics": return make_http_response(connection, 200, "text/plain; version=0.0.4", scrape_metrics())
+	elif path == "/stats": return make_http_response(connection, 200, "application/json", json.dumps({"cache": g.audio_cache.stats(), "disk_cache": g.audio_store.stats() if g.audio_store else None}))
 	elif path == "/synthesize":
 		args = urllib.parse.parse_qs(query.partition("#")[0])
 		if not args or not "voice" in args and not "text" in args: return connection.respond(400, "missing voice or text argument")
 		connection.send = web_send(connection)
-		connection.response = b""
 		voice = args["voice"][0].partition(":")[0] if "voice" in args and args["voice"] else ""
 		params = []
 		for arg in args:
@@ -212,23 +911,240 @@ async def connection_request_handler(connection, request):
 		if voice:
 			if params: voice += "<" + (" ".join(params)) + ">"
 			voice += ": "
-			g.next_web_id += 1
-		await handle_speech_request({"ws": connection, "id": g.next_web_id}, f"{voice}{args['text'][0]}")
-		while not connection.response:
-			await asyncio.sleep(0.1)
-		if isinstance(connection.response, str): return make_http_response(connection, 400, connection.response_mime, connection.response)
-		r = make_http_response(connection, 200, connection.response_mime, connection.response)
-		r.headers["content-disposition"] = f'inline; filename="speech{int(time.time())}.{connection.response_extension}"'
+		g.next_web_id += 1
+		client = {"ws": connection, "id": g.next_web_id, "username": getattr(connection, "username", None), "requests": set()}
+		await handle_speech_request(client, f"{voice}{args['text'][0]}", priority = 1)
+		try: status, mime, extension, body = await asyncio.wait_for(connection.send.response, g.http_timeout)
+		except asyncio.TimeoutError:
+			await abort_speech_requests(client)
+			return connection.respond(504, "timed out waiting for synthesis")
+		r = make_http_response(connection, status, mime, body)
+		if status == 200: r.headers["content-disposition"] = f'inline; filename="speech{int(time.time())}.{extension}"'
 		return r
 	else: return connection.respond(404, "not found")
 
-async def client_handler(ws):
-	"""Manages WebSocket client connections."""
+render_filename_tokens = {
+	# Mirrors the render filename template tokens of the user client, so that scripts rendered over HTTP are named the same way.
+	**{f"counter{'0' * (i + 1)}": lambda r, i = i: str(r["counter"] - 1).zfill(i + 1) for i in range(4)},
+	**{f"counter{'0' * i}1": lambda r, i = i: str(r["counter"]).zfill(i + 1) for i in range(4)},
+	**{f"line{'0' * i}0": lambda r, i = i: str(r["line"] - 1).zfill(i + 1) for i in range(4)},
+	**{f"line{'0' * i}1": lambda r, i = i: str(r["line"]).zfill(i + 1) for i in range(4)},
+	"voice": lambda r: r["original_voice"],
+	"voice_lower": lambda r: r["original_voice"].lower(),
+	"voice_slug": lambda r: slugify(r["original_voice"].lower(), "_", ["_"]),
+	"voice_aliased": lambda r: r["voice"],
+	"voice_lower_aliased": lambda r: r["voice"].lower(),
+	"voice_slug_aliased": lambda r: slugify(r["voice"].lower(), "_", ["_"]),
+	"text": lambda r: slugify(r["text"][:200]),
+	**{f"text{i}": lambda r, i = i: slugify(" ".join(r["text"][:200].split(" ")[:i])) for i in [1, 2, 3, 5, 10, 15, 20]},
+	"date": lambda r: time.strftime("%Y-%m-%d"),
+}
+
+def slugify(text, space_replacement = "", char_passthroughs = [" ", "_", "-", ",", ".", "!"]):
+	"""Utility to convert a string into a valid filename."""
+	if space_replacement: text = text.replace(" ", space_replacement)
+	return "".join(char for char in text if char.isalnum() or char in char_passthroughs)
+
+def parse_textline(textline, aliases = {}):
+	"""Splits a line of script (Mike<r=2>: Hi there) into a tuple of voicename, params, text in the same way as the user client, replacing the voicename using the given dictionary of lowercase aliases."""
+	text = textline.partition(":")
+	voicename = text[0].partition("<")
+	params = "<" + voicename[2] if voicename[2] else ""
+	voicename = voicename[0]
+	if voicename.lower() in aliases: voicename = aliases[voicename.lower()]
+	voicename, delim, default_params = voicename.partition("<")
+	if default_params: default_params = "<" + default_params
+	params = params if params else default_params
+	return (voicename, params, text[2].strip())
+
+def parse_script(script, template = "{counter01}"):
+	"""Parses a full STAR script with the same syntax the user client renders (voice aliases, comments and < > selection blocks), returning a list of (filename, speech line) tuples for the lines that should be rendered, or an error string."""
+	lines = script.strip().split("\n")
+	aliases = {}
+	for l in lines:
+		l = l.strip()
+		if not l.startswith("|"): continue
+		voice, sep, replacement = l[1:].partition("=")
+		if voice.strip() and replacement.strip(): aliases[voice.strip().lower()] = replacement.strip()
+	renderable_lines = []
+	selected_renderable_lines = []
+	selection_block_depth = 0
+	counter = 1
+	for i, l in enumerate(lines):
+		l = l.strip()
+		if l == "<" or l == ">":
+			selection_block_depth += (1 if l == "<" else -1)
+			continue
+		if not l or l.startswith(";") or not ": " in l: continue
+		orig_voice = parse_textline(l)[0]
+		voice, params, text = parse_textline(l, aliases)
+		if not voice or not text: continue
+		try: filename = template.format(**{k: v({"counter": counter, "line": i, "original_voice": orig_voice, "voice": voice, "text": text}) for k, v in render_filename_tokens.items()})
+		except Exception as e: return f"invalid render filename template {e}"
+		counter += 1
+		renderable_lines.append((filename, f"{voice}{params}: {text}"))
+		if selection_block_depth > 0: selected_renderable_lines.append(renderable_lines[-1])
+	if selection_block_depth: return f"unmatched render block selection tokens <> level {selection_block_depth}"
+	return selected_renderable_lines if selected_renderable_lines else renderable_lines
+
+class render_collector:
+	"""Stands in for a websocket when a script is rendered over HTTP, putting a tuple of (line index, meta, audio or error string) on the results queue as the outcome of each line is sent to it. Request ids take the form client_line_sequence, and warnings that carry no request id refer to the line currently being handled."""
+	def __init__(self):
+		self.results = asyncio.Queue()
+		self.line = None
+	async def send(self, message):
+		if isinstance(message, list): message = b"".join(message)
+		if isinstance(message, str):
+			msg = json.loads(message)
+			if "status" in msg and not msg.get("abort"): return
+			id = msg.get("request_id", msg.get("id"))
+			self.results.put_nowait((int(id.split("_")[1]) if id else self.line, None, msg.get("warning", msg.get("status", msg.get("error", "")))))
+		else:
+			meta, audio = parse_audio_frame(message)
+			self.results.put_nowait((int(meta["id"].split("_")[1]), meta, audio))
+
+class chunk_buffer:
+	"""A minimal write only file object that gathers what zipfile writes to it, so that the archive can be sent in HTTP chunks as it is built."""
+	def __init__(self): self.data = bytearray()
+	def write(self, data):
+		self.data += data
+		return len(data)
+	def flush(self): pass
+	def take(self):
+		data = bytes(self.data)
+		self.data.clear()
+		return data
+
+def wav_stream_header(channels, sample_width, rate):
+	"""Returns a wav header for PCM audio of unknown length, as is conventional when streaming."""
+	return b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVEfmt " + struct.pack("<IHHIIHH", 16, 1, channels, rate, rate * channels * sample_width, channels * sample_width, sample_width * 8) + b"data" + struct.pack("<I", 0xFFFFFFFF - 36)
+
+async def write_http_chunk(writer, data):
+	if not data: return
+	writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+	await writer.drain()
+
+def write_http_response(writer, status, reason, body = b"", mime = "text/plain", headers = {}):
+	"""Writes a complete http response, or just it's headers if body is None."""
+	if isinstance(body, str): body = body.encode()
+	headers = {"Content-Type": mime, "Connection": "close", **headers}
+	if body is not None: headers["Content-Length"] = len(body)
+	writer.write(f"HTTP/1.1 {status} {reason}\r\n".encode() + "".join(f"{k}: {v}\r\n" for k, v in headers.items()).encode() + b"\r\n" + (body or b""))
+
+async def render_script(writer, client, collector, lines, format, silence):
+	"""Dispatches every line of a parsed script and streams the results back as a chunked http response, either as a zip archive of individual clips written as they arrive or as a single wav track written in script order."""
+	write_http_response(writer, 200, "OK", None, "application/zip" if format == "zip" else "audio/wav", {"Transfer-Encoding": "chunked", "Content-Disposition": f'attachment; filename="render{int(time.time())}.{format}"'})
+	for i, line in enumerate(lines):
+		collector.line = i
+		await handle_speech_request(client, line[1], str(i))
+	buffer = chunk_buffer()
+	archive = zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) if format == "zip" else None
+	names = set()
+	errors = []
+	waiting = {}
+	next_line = 0
+	wav_params = None
+	for n in range(len(lines)):
+		try: line, meta, audio = await asyncio.wait_for(collector.results.get(), g.http_timeout)
+		except asyncio.TimeoutError:
+			errors.append("timed out waiting for the remaining lines")
+			break
+		if meta is None:
+			errors.append(f"{lines[line][0]}: {audio}")
+			audio = None
+		if archive:
+			if audio is None: continue
+			name = f"{lines[line][0]}.{meta.get('extension', 'wav')}"
+			if name in names: name = f"{lines[line][0]}_{line + 1}.{meta.get('extension', 'wav')}"
+			names.add(name)
+			archive.writestr(name, audio)
+			await write_http_chunk(writer, buffer.take())
+			continue
+		waiting[line] = audio
+		while next_line in waiting:
+			audio = waiting.pop(next_line)
+			next_line += 1
+			if audio is None: continue
+			try:
+				with wave.open(io.BytesIO(audio)) as w:
+					params = (w.getnchannels(), w.getsampwidth(), w.getframerate())
+					frames = w.readframes(w.getnframes())
+			except (wave.Error, EOFError):
+				errors.append(f"{lines[next_line - 1][0]}: not wav audio, cannot be consolidated")
+				continue
+			if not wav_params:
+				wav_params = params
+				await write_http_chunk(writer, wav_stream_header(*params))
+			elif params != wav_params:
+				errors.append(f"{lines[next_line - 1][0]}: audio format differs from the first line, cannot be consolidated")
+				continue
+			elif silence: await write_http_chunk(writer, (b"\x80" if params[1] == 1 else b"\0") * (params[0] * params[1] * (params[2] * silence // 1000)))
+			await write_http_chunk(writer, frames)
+	await abort_speech_requests(client)
+	if archive:
+		if errors: archive.writestr("errors.txt", "\n".join(errors))
+		archive.close()
+		await write_http_chunk(writer, buffer.take())
+	writer.write(b"0\r\n\r\n")
+	await writer.drain()
+
+async def render_request_handler(reader, writer):
+	"""Serves the coagulator's bulk render endpoint, which accepts a full STAR script as the body of a POST request to /render and streams back either a zip archive of the rendered lines (the default) or a single consolidated wav track with ?format=wav. Optional query arguments are template for the zip's filename template, and silence for the milliseconds of silence between consolidated lines. This is a separate tiny http server, as the websockets library which serves the rest of the HTTP frontend does not support request bodies or streamed responses."""
+	client = None
+	try:
+		request_line = (await reader.readline()).decode("latin-1")
+		if not request_line: return
+		request_line = request_line.split(" ", 2)
+		if len(request_line) != 3: return write_http_response(writer, 400, "Bad Request", "malformed request line")
+		method, target, version = request_line
+		headers = {}
+		while True:
+			line = (await reader.readline()).decode("latin-1").strip()
+			if not line: break
+			key, sep, value = line.partition(":")
+			headers[key.strip().lower()] = value.strip()
+		username = None
+		if not g.authless:
+			scheme, sep, credentials = headers.get("authorization", "").partition(" ")
+			try: username, sep, password = base64.b64decode(credentials).decode().partition(":")
+			except ValueError: username = password = ""
+			if scheme.lower() != "basic" or not check_credentials(username, password): return write_http_response(writer, 401, "Unauthorized", "invalid credentials", headers = {"WWW-Authenticate": 'Basic realm="STAR"'})
+		path, delim, query = target.partition("?")
+		if path != "/render": return write_http_response(writer, 404, "Not Found", "not found")
+		if method != "POST": return write_http_response(writer, 405, "Method Not Allowed", "POST a script to render", headers = {"Allow": "POST"})
+		try: length = int(headers.get("content-length", 0))
+		except ValueError: return write_http_response(writer, 400, "Bad Request", "Content-Length must be a number")
+		if length < 1 or length > int(g.config.get("max_packet_size", 1024 * 1024 * 10)): return write_http_response(writer, *((413, "Payload Too Large") if length else (411, "Length Required")), "a script of a sane size is required")
+		script = (await reader.readexactly(length)).decode("UTF-8", "replace")
+		args = {k: v[0] for k, v in urllib.parse.parse_qs(query).items()}
+		format = args.get("format", "zip").lower()
+		if format not in ["zip", "wav"]: return write_http_response(writer, 400, "Bad Request", "format must be zip or wav")
+		try: silence = max(0, int(args.get("silence", 200)))
+		except ValueError: return write_http_response(writer, 400, "Bad Request", "silence must be a whole number of milliseconds")
+		lines = parse_script(script, args.get("template", "{counter01}"))
+		if isinstance(lines, str) or not lines: return write_http_response(writer, 400, "Bad Request", lines or "no renderable data")
+		g.next_web_id += 1
+		client = {"ws": render_collector(), "id": g.next_web_id, "username": username, "requests": set()}
+		await render_script(writer, client, client["ws"], lines, format, silence)
+	except (ConnectionError, asyncio.IncompleteReadError): pass
+	except Exception: traceback.print_exc()
+	finally:
+		if client: await abort_speech_requests(client)
+		try:
+			await writer.drain()
+			writer.close()
+		except ConnectionError: pass
+
+async def client_handler(ws, peer_link = False):
+	"""Manages WebSocket client connections. This also handles the connections this coagulator makes to it's peers, which are then treated exactly as if the peer had connected to us."""
 	client_id = g.next_client_id
 	g.next_client_id += 1
-	client = {"ws": ws, "id": client_id}
+	client = {"ws": ws, "id": client_id, "username": getattr(ws, "username", None), "in_flight": 0, "requests": set(), "dispatched": set(), "voices": set()}
 	g.clients[client_id] = client
 	try:
+		if peer_link:
+			client["advertised"] = None
+			await advertise_voices(client)
 		async for message in ws:
 			await on_message(ws, client, message)
 	except websockets.ConnectionClosed:
@@ -240,7 +1156,20 @@ async def client_handler(ws):
 	except: traceback.print_exc()
 	finally:
 		del(g.clients[client_id])
-		await on_client_disconnect(ws, client_id)
+		await on_client_disconnect(ws, client)
+
+async def connect_to_peer(uri):
+	"""Runs for the life of the coagulator, keeping a link open to a peer coagulator listed in the peers setting and reconnecting a few seconds after it drops."""
+	while True:
+		try:
+			async with websockets.asyncio.client.connect(uri, max_size = int(g.config.get("max_packet_size", 1024 * 1024 * 10)), max_queue = 4096, compression = None) as ws:
+				await client_handler(ws, True)
+		except (OSError, websockets.exceptions.WebSocketException) as e: print(f"peer link to {uri} failed, {e}")
+		await asyncio.sleep(5)
+
+def check_credentials(username, password):
+	"""Returns True if the given username and password belong to a user in the coagulator's configuration."""
+	return "users" in g.config and username in g.config["users"] and g.config["users"][username].get("password", "") == password
 
 def handle_args():
 	"""Uses argparse to process and apply command line arguments."""
@@ -355,11 +1284,40 @@ def configuration():
 async def main():
 	g.speech_requests = {}
 	g.voices = {}
+	g.voice_order = {}
+	g.next_voice_order = 0
+	g.voice_index = {}
+	g.user_voices = {}
+	g.voice_resolutions = {}
 	g.clients = {}
 	handle_args()
 	if g.do_configuration_interface: return configuration()
-	g.authorize = websockets.asyncio.server.basic_auth(check_credentials = lambda username, password: "users" in g.config and username in g.config["users"] and g.config["users"][username].get("password", "") == password)
-	async with websockets.asyncio.server.serve(client_handler, g.config.get("bind_address", "0.0.0.0"), int(g.config.get("bind_port", 7774)), max_size = int(g.config.get("max_packet_size", 1024 * 1024 * 10)), max_queue = 4096,  process_request = connection_request_handler):
+	g.provider_window = int(g.config.get("provider_window", 8))
+	g.max_provider_window = int(g.config.get("max_provider_window", 64))
+	g.dispatch_quantum = int(g.config.get("dispatch_quantum", 500))
+	g.dispatch_lookahead = max(int(g.config.get("dispatch_lookahead", 256)), 1)
+	g.audio_cache = audio_cache(int(float(g.config.get("cache_size", 64)) * 1024 * 1024))
+	g.audio_store = audio_store(g.config["disk_cache_path"], int(float(g.config.get("disk_cache_size", 1024)) * 1024 * 1024), float(g.config.get("disk_cache_max_age", 0)) * 86400) if g.config.get("disk_cache_path", "") else None
+	g.background_tasks = set()
+	g.metrics = metrics()
+	g.http_timeout = float(g.config.get("http_timeout", 60))
+	g.request_timeout = float(g.config.get("request_timeout", 120))
+	g.max_retries = int(g.config.get("max_retries", 2))
+	g.coagulator_id = g.config.get("coagulator_id", "") or os.urandom(8).hex()
+	g.max_hops = int(g.config.get("max_hops", 3))
+	g.peer_window = int(g.config.get("peer_window", 32))
+	g.user_queues = {}
+	g.requests_by_key = {}
+	g.dispatch_order = collections.deque()
+	g.deficits = {}
+	g.dispatch_event = asyncio.Event()
+	asyncio.create_task(dispatcher())
+	if g.request_timeout > 0: asyncio.create_task(request_reaper())
+	peers = g.config.get("peers", [])
+	for uri in [peers] if isinstance(peers, str) else peers: asyncio.create_task(connect_to_peer(uri))
+	g.authorize = websockets.asyncio.server.basic_auth(check_credentials = check_credentials)
+	if g.config.get("render_port", "") and (not "http_frontend" in g.config or g.config.as_bool("http_frontend")): await asyncio.start_server(render_request_handler, g.config.get("bind_address", "0.0.0.0"), int(g.config["render_port"]))
+	async with websockets.asyncio.server.serve(client_handler, g.config.get("bind_address", "0.0.0.0"), int(g.config.get("bind_port", 7774)), max_size = int(g.config.get("max_packet_size", 1024 * 1024 * 10)), max_queue = 4096, compression = "deflate" if "websocket_compression" in g.config and g.config.as_bool("websocket_compression") else None, process_request = connection_request_handler):
 		print("Coagulator up.")
 		await asyncio.get_running_loop().create_future()
 
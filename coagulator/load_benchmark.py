@@ -0,0 +1,169 @@
+# A load generator that measures the throughput and latency of the coagulator without any real speech engines.
+# It starts it's own coagulator from this directory on a spare port, connects synthetic providers built on the usual star_provider class whose voices answer after a random delay with random audio (sometimes failing on purpose), and then has synthetic users request lines from random voices as fast as the coagulator will let them.
+# Requests per second, percentiles of how long requests spent getting from users to providers and from providers back to users, and the coagulator's memory and CPU usage are reported at the end, so that changes to voice lookup, dispatching, relaying or voice list broadcasting can be compared before and after.
+# The provider class needs it's usual requirements (including wxPython) to be installed. Memory and CPU usage are only reported on Linux. For example: python load_benchmark.py --providers 8 --voices 50 --users 20 --requests 500
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import websockets.asyncio.client
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "provider"))
+from provider import star_provider
+
+class load_provider(star_provider):
+	"""A provider offering a number of synthetic voices, whose synthesis sleeps for a delay drawn from the configured latency distribution before returning random bytes or, at the configured failure rate, an error. The times at which each line of text was received and answered are recorded in timings."""
+	def __init__(self, number, args, host, directory, timings):
+		self.number = number
+		self.args = args
+		self.hosts = [host]
+		self.timings = timings
+		self.payload = os.urandom(args.payload_size * 1024)
+		super().__init__(os.path.join(directory, f"load_provider_{number}"), handle_argv = False, run_immedietly = False)
+		self.config["concurrent_requests"] = args.provider_concurrency
+	def get_voices(self):
+		return [f"load voice {self.number}x{v}" for v in range(self.args.voices)]
+	async def synthesize(self, voice, text, rate = None, pitch = None):
+		received = time.perf_counter()
+		await asyncio.sleep(sample_latency(self.args))
+		self.timings[text] = (received, time.perf_counter())
+		if random.random() < self.args.failure_rate: return "synthetic failure"
+		return self.payload
+
+def sample_latency(args):
+	"""Returns a synthesis delay in seconds drawn from the distribution chosen on the command line, with the configured mean."""
+	if args.latency_distribution == "fixed": return args.latency
+	if args.latency_distribution == "uniform": return random.uniform(0, args.latency * 2)
+	return random.expovariate(1 / args.latency) if args.latency > 0 else 0
+
+class user_stats:
+	"""Totals collected by all synthetic users. The latency lists hold seconds for every successful request: dispatch from the user sending the request until the provider received it, relay from the provider answering until the user received the audio, and total for the whole round trip."""
+	def __init__(self):
+		self.completed = 0
+		self.failed = 0
+		self.dispatch = []
+		self.relay = []
+		self.total = []
+
+async def run_user(uri, number, args, stats, timings):
+	"""Requests args.requests lines from random voices, keeping up to args.window of them outstanding."""
+	async with websockets.asyncio.client.connect(uri, max_size = None, max_queue = 4096) as ws:
+		await ws.send(json.dumps({"user": 4, "voice_deltas": not args.full_voice_lists}))
+		voices = [v for v in json.loads(await ws.recv())["voices"] if v.startswith("load voice ")]
+		outstanding = {}
+		sent = 0
+		while sent < args.requests or outstanding:
+			while sent < args.requests and len(outstanding) < args.window:
+				voice = random.choice(voices)
+				if args.partial_names: voice = voice.rpartition(" ")[2]
+				text = f"line {number} {sent}"
+				outstanding[str(sent)] = (text, time.perf_counter())
+				await ws.send(json.dumps({"user": 4, "request": f"{voice}: {text}", "id": str(sent)}))
+				sent += 1
+			message = await ws.recv()
+			received = time.perf_counter()
+			if isinstance(message, str):
+				event = json.loads(message)
+				id = event.get("id", event.get("request_id"))
+				if not id or not ("abort" in event or "warning" in event): continue
+				stats.failed += 1
+			else:
+				id = json.loads(bytes(message[2:2 + int.from_bytes(message[:2], "little")]))["id"]
+				stats.completed += 1
+			text, start = outstanding.pop(id.split("_")[-2])
+			if isinstance(message, str) or text not in timings: continue
+			provider_received, provider_sent = timings.pop(text)
+			stats.dispatch.append(provider_received - start)
+			stats.relay.append(received - provider_sent)
+			stats.total.append(received - start)
+
+async def churn_voices(uri, interval):
+	"""Repeatedly connects and disconnects a provider with a batch of voices every interval seconds, so that every user is sent voice list changes while the benchmark runs."""
+	batch = 0
+	while True:
+		async with websockets.asyncio.client.connect(uri) as ws:
+			await ws.send(json.dumps({"provider": 4, "provider_name": "load_churn", "voices": [f"churn voice {batch}x{v}" for v in range(20)]}))
+			await asyncio.sleep(interval / 2)
+		batch += 1
+		await asyncio.sleep(interval / 2)
+
+def process_usage(pid):
+	"""Returns a tuple of the resident memory in megabytes and the seconds of CPU time used so far by a process, or None where /proc is not available."""
+	try:
+		with open(f"/proc/{pid}/status") as f: rss = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:")) / 1024
+		with open(f"/proc/{pid}/stat") as f: fields = f.read().rpartition(")")[2].split()
+		return rss, (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+	except (OSError, ValueError, StopIteration): return None
+
+def percentile(values, fraction):
+	if not values: return 0
+	values = sorted(values)
+	return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def free_port():
+	with socket.socket() as s:
+		s.bind(("127.0.0.1", 0))
+		return s.getsockname()[1]
+
+async def wait_for_port(port, process):
+	while process.poll() is None:
+		try:
+			reader, writer = await asyncio.open_connection("127.0.0.1", port)
+			writer.close()
+			return
+		except OSError: await asyncio.sleep(0.1)
+	sys.exit("the coagulator exited before it began listening")
+
+async def main():
+	p = argparse.ArgumentParser(description = "Measures coagulator throughput and latency using synthetic providers and users.")
+	p.add_argument("--providers", type = int, default = 4)
+	p.add_argument("--voices", type = int, default = 10, help = "number of voices each provider offers")
+	p.add_argument("--provider-concurrency", type = int, default = 4, help = "concurrent_requests setting of each provider")
+	p.add_argument("--latency", type = float, default = 0.05, help = "mean seconds each provider takes to synthesize a line")
+	p.add_argument("--latency-distribution", choices = ("exponential", "uniform", "fixed"), default = "exponential")
+	p.add_argument("--payload-size", type = int, default = 64, help = "kilobytes of audio returned for each line")
+	p.add_argument("--failure-rate", type = float, default = 0, help = "fraction of lines that providers fail to synthesize")
+	p.add_argument("--users", type = int, default = 4)
+	p.add_argument("--requests", type = int, default = 200, help = "number of lines each user requests")
+	p.add_argument("--window", type = int, default = 8, help = "number of requests each user keeps outstanding")
+	p.add_argument("--partial-names", action = "store_true", help = "request voices by the last word of their name rather than in full, exercising voice search")
+	p.add_argument("--full-voice-lists", action = "store_true", help = "have users receive the full voice list on every change rather than deltas")
+	p.add_argument("--churn", type = float, default = 0, help = "if set, a provider with a batch of voices connects and disconnects every this many seconds")
+	p.add_argument("--config", default = "", help = "extra lines for the coagulator's configuration, such as \"provider_window = 4\"")
+	args = p.parse_args()
+	directory = tempfile.mkdtemp(prefix = "star_load_")
+	with open(os.path.join(directory, "coagulator.ini"), "w") as f: f.write("cache_size = 0\n" + args.config.replace("\\n", "\n") + "\n")
+	port = free_port()
+	uri = f"ws://127.0.0.1:{port}"
+	coagulator = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "coagulator.py"), "--authless", "--port", str(port), "--config", os.path.join(directory, "coagulator.ini")], cwd = directory, stdout = subprocess.DEVNULL)
+	tasks = []
+	try:
+		await wait_for_port(port, coagulator)
+		timings = {}
+		for i in range(args.providers): tasks.append(asyncio.create_task(load_provider(i, args, uri, directory, timings).async_main()))
+		await asyncio.sleep(1 + args.providers * args.voices / 5000)
+		if args.churn > 0: tasks.append(asyncio.create_task(churn_voices(uri, args.churn)))
+		stats = user_stats()
+		usage_before = process_usage(coagulator.pid)
+		start = time.perf_counter()
+		await asyncio.gather(*[run_user(uri, i, args, stats, timings) for i in range(args.users)])
+		elapsed = time.perf_counter() - start
+		usage_after = process_usage(coagulator.pid)
+	finally:
+		for task in tasks: task.cancel()
+		coagulator.terminate()
+	print(f"{stats.completed} requests completed and {stats.failed} failed in {elapsed:.2f}s, {(stats.completed + stats.failed) / elapsed:.1f} requests/s")
+	for name, values in (("dispatch", stats.dispatch), ("relay", stats.relay), ("total", stats.total)):
+		print(f"{name} latency: p50 {percentile(values, 0.5) * 1000:.1f}ms, p99 {percentile(values, 0.99) * 1000:.1f}ms, max {max(values, default = 0) * 1000:.1f}ms")
+	if usage_before and usage_after:
+		print(f"coagulator memory: {usage_before[0]:.1f}MB before, {usage_after[0]:.1f}MB after ({usage_after[0] - usage_before[0]:+.1f}MB)")
+		print(f"coagulator CPU: {usage_after[1] - usage_before[1]:.2f}s, {(usage_after[1] - usage_before[1]) / elapsed * 100:.0f}% of one core")
+
+if __name__ == "__main__": asyncio.run(main())
@@ -0,0 +1,61 @@
+# A micro-benchmark that measures how quickly a running coagulator relays audio from providers to users.
+# It connects a fake provider offering a single voice which answers every request with a fixed clip, then has one or more users request lines from it as fast as the coagulator will let them, reporting the megabytes of audio relayed per second.
+# Start a coagulator with --authless (or put credentials in the URI) and then run, for example: python relay_benchmark.py ws://127.0.0.1:7774 --clip-size 256 --count 400
+
+import argparse
+import asyncio
+import json
+import os
+import time
+import websockets.asyncio.client
+
+async def run_provider(uri, voice, clip, ready):
+	async with websockets.asyncio.client.connect(uri, max_size = None, max_queue = 4096) as ws:
+		await ws.send(json.dumps({"provider": 4, "provider_name": "relay_benchmark", "voices": [voice]}))
+		ready.set()
+		async for message in ws:
+			event = json.loads(message)
+			if not "text" in event: continue
+			meta = json.dumps({"id": event["id"]}).encode()
+			await ws.send(len(meta).to_bytes(2, "little") + meta + clip)
+
+async def run_user(uri, voice, count, window, user_number):
+	"""Requests count lines, keeping up to window of them outstanding, and returns the number of audio bytes received."""
+	received = 0
+	async with websockets.asyncio.client.connect(uri, max_size = None, max_queue = 4096) as ws:
+		await ws.send(json.dumps({"user": 4}))
+		await ws.recv()
+		sent = 0
+		outstanding = 0
+		while sent < count or outstanding:
+			while sent < count and outstanding < window:
+				# The text is unique to every request so that the coagulator's cache is never hit.
+				await ws.send(json.dumps({"user": 4, "request": f"{voice}: line {user_number} {sent} {time.time()}"}))
+				sent += 1
+				outstanding += 1
+			message = await ws.recv()
+			if isinstance(message, str): raise RuntimeError(message)
+			received += len(message) - 2 - int.from_bytes(message[:2], "little")
+			outstanding -= 1
+	return received
+
+async def main():
+	p = argparse.ArgumentParser(description = "Measures the audio relay throughput of a running coagulator.")
+	p.add_argument("uri", nargs = "?", default = "ws://127.0.0.1:7774")
+	p.add_argument("--clip-size", type = int, default = 256, help = "kilobytes of audio the fake provider returns for each request")
+	p.add_argument("--count", type = int, default = 400, help = "number of requests each user makes")
+	p.add_argument("--users", type = int, default = 1)
+	p.add_argument("--window", type = int, default = 8, help = "number of requests each user keeps outstanding")
+	args = p.parse_args()
+	voice = f"relay benchmark {int(time.time())}"
+	ready = asyncio.Event()
+	provider = asyncio.create_task(run_provider(args.uri, voice, os.urandom(args.clip_size * 1024), ready))
+	await ready.wait()
+	await asyncio.sleep(0.5)
+	start = time.perf_counter()
+	received = sum(await asyncio.gather(*[run_user(args.uri, voice, args.count, args.window, i) for i in range(args.users)]))
+	elapsed = time.perf_counter() - start
+	provider.cancel()
+	print(f"relayed {received / 1048576:.1f} MB in {elapsed:.2f}s, {received / 1048576 / elapsed:.1f} MB/s, {args.count * args.users / elapsed:.0f} clips/s")
+
+if __name__ == "__main__": asyncio.run(main())
@@ -0,0 +1,65 @@
+# Checks how the adaptive concurrency limit used by cloud providers behaves against a simulated speech API, without needing an account with any real one.
+# Simulated requests take a fixed overhead plus a time for every character of a line whose length is drawn at random, so that lines of very different lengths are mixed as they are in real scripts. Optionally the API rejects requests beyond a number running at once with a rate limit error, slows down once more than a number are running, or has some requests canceled part way through.
+# The limit is printed as it changes, and the script exits with an error if it ends up outside the range expected of the scenario: with no rate limit or slowdown the limit should climb to it's maximum however much line lengths vary, and otherwise it should settle near the point where the API starts to struggle. For example: python concurrency_simulation.py --rate-limit 10
+
+import argparse
+import asyncio
+import random
+import sys
+import time
+from provider import concurrency_limit
+
+async def simulate(args, limit):
+	"""Runs as many simulated requests as the limit allows for args.seconds, sampling the limit every half second."""
+	active = 0
+	async def handler():
+		nonlocal active
+		while True:
+			await limit.acquire()
+			try:
+				started, saturated = limit.begin()
+				size = random.randint(args.min_length, args.max_length)
+				active += 1
+				outcome = None
+				if random.random() < args.cancel_rate: outcome = False
+				elif args.rate_limit and active > args.rate_limit:
+					await asyncio.sleep(args.overhead / 4)
+					outcome = "Error code: 429 - Too many requests"
+				else: await asyncio.sleep((args.overhead + args.per_character * size) * (max(1, active / args.slowdown) if args.slowdown else 1))
+				active -= 1
+				limit.end(started, saturated, outcome, type(outcome) == str, size)
+			finally: limit.release()
+	handlers = [asyncio.create_task(handler()) for i in range(limit.maximum)]
+	samples = []
+	end = time.monotonic() + args.seconds
+	while time.monotonic() < end:
+		await asyncio.sleep(0.5)
+		samples.append(limit.limit)
+	for h in handlers: h.cancel()
+	return samples
+
+def main():
+	p = argparse.ArgumentParser(description = "Simulates a speech API to check how the adaptive concurrency limit responds to line lengths, rate limits and slowdowns.")
+	p.add_argument("--initial", type = int, default = 8, help = "concurrent_requests setting, where the limit starts")
+	p.add_argument("--maximum", type = int, default = 32, help = "max_concurrent_requests setting")
+	p.add_argument("--overhead", type = float, default = 0.02, help = "seconds each simulated request takes regardless of it's length")
+	p.add_argument("--per-character", type = float, default = 0.001, help = "seconds each character of a line adds")
+	p.add_argument("--min-length", type = int, default = 5)
+	p.add_argument("--max-length", type = int, default = 300)
+	p.add_argument("--rate-limit", type = int, default = 0, help = "if set, requests beyond this many at once fail with a rate limit error")
+	p.add_argument("--slowdown", type = int, default = 0, help = "if set, requests slow down in proportion once more than this many are running")
+	p.add_argument("--cancel-rate", type = float, default = 0, help = "fraction of requests canceled before they finish")
+	p.add_argument("--seconds", type = float, default = 10)
+	args = p.parse_args()
+	limit = concurrency_limit(args.initial, maximum = args.maximum)
+	samples = asyncio.run(simulate(args, limit))
+	print("limit every second: " + ", ".join(f"{s:.1f}" for s in samples[1::2]))
+	print(limit.report())
+	settled = sum(samples[len(samples) // 2:]) / max(len(samples) - len(samples) // 2, 1)
+	if args.rate_limit or args.slowdown:
+		ceiling = min(args.rate_limit or args.maximum, args.slowdown * 2 or args.maximum)
+		if not ceiling / 2 <= settled <= ceiling * 1.5: sys.exit(f"the limit settled around {settled:.1f}, expected between {ceiling / 2:.1f} and {ceiling * 1.5:.1f}")
+	elif settled < args.maximum * 0.9: sys.exit(f"the limit settled around {settled:.1f} with nothing to hold it back, expected close to {args.maximum}")
+	print(f"ok, the limit settled around {settled:.1f}")
+
+if __name__ == "__main__": main()
@@ -8,6 +8,7 @@ from elevenlabs.client import ElevenLabs, AsyncElevenLabs
 from elevenlabs import VoiceSettings
 
 class eleven(star_provider):
+	adaptive_concurrency = True
 	def __init__(self):
 		self.client = None
 		super().__init__(synthesis_audio_extension="mp3")
@@ -46,16 +47,13 @@ class eleven(star_provider):
 			if audio_iter is None:
 				raise RuntimeError("TTS generation failed: no audio stream returned.")
 
-			audio = b""
 			async for chunk in audio_iter:
 				if isinstance(chunk, bytes):
-					audio += chunk
+					yield chunk
 
-			return audio
-
-		except Exception:
+		except Exception as e:
 			traceback.print_exc()
-			return None
+			yield str(e)
 
 	def add_configuration_options(self, panel):
 		wx.StaticText(panel, -1, "Eleven Labs API Key")
@@ -9,6 +9,7 @@ sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 from provider import star_provider
 
 class googlecloud(star_provider):
+	adaptive_concurrency = True
 	async def get_voices(self):
 		if not self.config.get("api_key", ""): return [] # Provider needs configuration
 		self.client = texttospeech_v1.TextToSpeechAsyncClient(client_options = {"api_key": self.config["api_key"]})
@@ -8,6 +8,7 @@ sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 from provider import star_provider
 
 class openaiplatform(star_provider):
+	adaptive_concurrency = True
 	def get_voices(self):
 		self.client = None
 		voices = []
@@ -17,14 +18,17 @@ class openaiplatform(star_provider):
 		return voices
 	async def synthesize(self, voice, text, rate=None, pitch=None):
 		model = "tts-1"
-		if voice not in self.voices: return f"Error: Voice '{voice}' is not supported"
+		if voice not in self.voices:
+			yield f"Error: Voice '{voice}' is not supported"
+			return
 		if voice.endswith(" hd"):
 			model += "-hd"
 			voice = voice[:-3]
 		if not self.client: self.client = openai.AsyncOpenAI(api_key = self.config.get("api_key", ""))
 		kwargs = dict(model = model, voice = voice, input = text, response_format = "wav")
 		if rate: kwargs["speed"] = rate
-		return (await self.client.audio.speech.create(**kwargs)).content
+		async with self.client.audio.speech.with_streaming_response.create(**kwargs) as response:
+			async for chunk in response.iter_bytes(16384): yield chunk
 	def add_configuration_options(self, panel):
 		wx.StaticText(panel, -1, "OpenAI API &Key")
 		panel.api_key = wx.TextCtrl(panel, value = self.config.get("api_key", ""))
@@ -8,9 +8,10 @@ import traceback
 import wx
 import os, sys
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
-from provider import star_provider
+from provider import star_provider, blocking
 
 class polly(star_provider):
+	adaptive_concurrency = True
 	def __init__(self):
 		self.language_codes = ["en-US", "en-GB", "en-IN", "en-AU", "en-GB-WLS", "en-NZ", "en-ZA", "en-IE"]
 		self.engines = ["standard", "neural", "generative"]
@@ -43,12 +44,16 @@ class polly(star_provider):
 			prosody += f'pitch="{pitch}" '
 		if prosody: text = f"<speak>{prosody}>{text}</prosody></speak>"
 		else: text = f"<speak>{text}</speak>"
+		audio = await self.synthesize_speech(text, voice_engine, voice_id)
+		if type(audio) == bytes: self.audio_cache[cache_id] = audio
+		return audio
+	@blocking # boto3 is synchronous, so this runs on the provider's thread pool.
+	def synthesize_speech(self, text, voice_engine, voice_id):
 		try: response = self.polly.synthesize_speech(Text = text, TextType = "ssml", Engine = voice_engine, VoiceId = voice_id, OutputFormat = "mp3", SampleRate = "24000")
 		except (BotoCoreError, ClientError) as e: return str(e)
 		if not "AudioStream" in response: return "response from amazon contains no audio stream! " + str(response)
 		audio = response["AudioStream"].read()
 		response["AudioStream"].close()
-		self.audio_cache[cache_id] = audio
 		return audio
 	def add_configuration_options(self, panel):
 		self.engine_options = {}
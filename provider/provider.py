@@ -4,10 +4,17 @@ PROVIDER_REVISION = 4
 
 import argparse
 import asyncio
+import concurrent.futures
 import configobj
+import functools
+import heapq
+import inspect
 import json
+import math
 import multiprocessing
 import os
+import re
+import shutil
 import subprocess
 import sys
 import tempfile
@@ -67,6 +74,8 @@ class star_provider_configurator(wx.Dialog):
 		self.voices_list.Bind(wx.EVT_LIST_ITEM_ACTIVATED, self.on_edit_voice)
 		wx.StaticText(self, -1, "Number of &concurrent requests")
 		self.concurrent_requests = wx.SpinCtrl(self, value = str(int(provider.config.get("concurrent_requests", multiprocessing.cpu_count() / 2))), min = 1, max = multiprocessing.cpu_count() * 4)
+		self.adaptive_concurrency = wx.CheckBox(self, label = "&Adjust the number of concurrent requests automatically, starting from the number above")
+		self.adaptive_concurrency.Value = provider.config.as_bool("adaptive_concurrency") if "adaptive_concurrency" in provider.config else provider.adaptive_concurrency
 		provider.add_configuration_options(self)
 		self.hosts_list.Focus(0)
 		self.hosts_list.SetFocus()
@@ -96,6 +105,7 @@ class star_provider_configurator(wx.Dialog):
 		c = configobj.ConfigObj(self.provider.config_filename)
 		c["hosts"] = [self.hosts_list.GetItemText(i) for i in range(self.hosts_list.GetItemCount())]
 		c["concurrent_requests"] = self.concurrent_requests.Value
+		c["adaptive_concurrency"] = self.adaptive_concurrency.Value
 		for voice in self.provider.voices:
 			voice = self.provider.voices[voice]
 			if not voice["enabled"] or "alias" in voice and voice["alias"]:
@@ -105,9 +115,164 @@ class star_provider_configurator(wx.Dialog):
 		self.provider.write_configuration_options(self, c)
 		c.write()
 
+rate_limit_pattern = re.compile(r"\b(429|503)\b|rate.?limit|too many requests|throttl|resource.?exhausted|quota|overloaded|slow ?down", re.I)
+
+audio_encoders = {
+	"flac": ["-c:a", "flac", "-f", "flac"],
+	"opus": ["-c:a", "libopus", "-b:a", "{opus_bitrate}", "-f", "ogg"],
+}
+
+def blocking(func):
+	"""Decorator for methods of star_provider subclasses that block while they work, such as those calling synchronous speech libraries or web APIs. The decorated method becomes a coroutine that runs the original on the provider's thread pool, so that the provider keeps receiving requests and aborts and running it's other concurrent requests in the meantime."""
+	@functools.wraps(func)
+	async def wrapper(self, *args, **kwargs): return await self.run_blocking(func, self, *args, **kwargs)
+	return wrapper
+
+class synthesis_worker:
+	"""A long running engine process started from a provider's synthesis_worker command, which synthesizes one line after another rather than being started again (and loading it's voice again) for every line. Each request is written to the process's standard input as a line of JSON containing voice, text, rate and pitch keys, and the process answers on standard output with a line of JSON containing either the length of the audio that immediately follows it, {"length": 12345}, or {"error": "message"}."""
+	def __init__(self, args, voice = None):
+		self.args = args
+		self.voice = voice
+		self.process = None
+		self.requests = 0
+	async def start(self):
+		self.process = await asyncio.create_subprocess_exec(*self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, creationflags = subprocess.CREATE_NO_WINDOW if sys.platform == "win32" else 0)
+	@property
+	def alive(self): return self.process is not None and self.process.returncode is None
+	async def synthesize(self, voice, text, rate, pitch, timeout):
+		self.requests += 1
+		self.voice = voice
+		self.process.stdin.write(json.dumps({"voice": voice, "text": text, "rate": rate, "pitch": pitch}).encode() + b"\n")
+		await self.process.stdin.drain()
+		header = await asyncio.wait_for(self.process.stdout.readline(), timeout)
+		if not header: raise OSError(f"{self.args[0]} exited with code {await self.process.wait()}")
+		header = json.loads(header)
+		if "error" in header: return str(header["error"])
+		return await asyncio.wait_for(self.process.stdout.readexactly(int(header["length"])), timeout)
+	def kill(self):
+		if self.alive: self.process.kill()
+
+class task_scheduler:
+	"""Decides which speech request a provider works on next. Requests with a higher priority (such as user previews) always go first, then any that must be started soonest before the coagulator that sent them gives up, then the rest in the order they arrived so that the lines of a render come back in script order. Each host the provider is connected to has it's own queue, and hosts with work waiting at the same priority take turns so that a large render through one coagulator can't hold up the others. Queue depths and waiting times are counted for each host until they are next reported."""
+	def __init__(self):
+		self.queues = {}
+		self.turns = []
+		self.available = asyncio.Semaphore(0)
+		self.sequence = 0
+		self.stats = {}
+	def put(self, host, websocket, event):
+		try: priority = int(event.get("priority", 0))
+		except (TypeError, ValueError): priority = 0
+		now = time.monotonic()
+		try: deadline = now + float(event["timeout"])
+		except (KeyError, TypeError, ValueError): deadline = math.inf
+		self.sequence += 1
+		if host not in self.queues:
+			self.queues[host] = []
+			self.turns.append(host)
+		heapq.heappush(self.queues[host], (-priority, deadline, self.sequence, now, websocket, event))
+		stats = self.host_stats(host)
+		stats["queued"] += 1
+		stats["max_depth"] = max(stats["max_depth"], len(self.queues[host]))
+		self.available.release()
+	async def get(self):
+		"""Waits for a request, returning a tuple of the websocket it arrived on, the request, and whether it's deadline passed while it was waiting."""
+		await self.available.acquire()
+		host = min(self.turns, key = lambda h: self.queues[h][0][0])
+		priority, deadline, sequence, queued, websocket, event = heapq.heappop(self.queues[host])
+		self.turns.remove(host)
+		if self.queues[host]: self.turns.append(host)
+		else: del self.queues[host]
+		now = time.monotonic()
+		stats = self.host_stats(host)
+		stats["started"] += 1
+		stats["total_wait"] += now - queued
+		stats["max_wait"] = max(stats["max_wait"], now - queued)
+		if now > deadline: stats["expired"] += 1
+		return websocket, event, now > deadline
+	def host_stats(self, host):
+		if host not in self.stats: self.stats[host] = {"queued": 0, "started": 0, "expired": 0, "max_depth": 0, "total_wait": 0.0, "max_wait": 0.0}
+		return self.stats[host]
+	def depth(self, host = None):
+		"""Returns the number of requests waiting for the given host, or for all hosts."""
+		if host is not None: return len(self.queues.get(host, []))
+		return sum(len(q) for q in self.queues.values())
+	def report(self):
+		"""Returns a line describing the queue of each host that has had any activity since the last report, and starts counting again."""
+		lines = []
+		for host, stats in self.stats.items():
+			mean_wait = stats["total_wait"] / stats["started"] if stats["started"] else 0
+			lines.append(f"{host}: {self.depth(host)} waiting (at most {stats['max_depth']}), {stats['queued']} queued, {stats['started']} started, {stats['expired']} past their deadline, wait {mean_wait * 1000:.0f}ms mean {stats['max_wait'] * 1000:.0f}ms max")
+		self.stats = {}
+		return lines
+
+class concurrency_limit:
+	"""Adjusts how many requests a provider works on at once from how they turn out, for providers such as cloud APIs whose best concurrency depends on rate limits and network latency rather than local CPUs. As synthesis takes longer for longer lines, each successful request's latency is compared with the quickest request for a line of similar length (within a factor of two) among the last window to two windows of requests, and the ratio is smoothed into slowdown. While requests are using the whole limit and slowdown stays within tolerance, the limit grows by about one each time a limit's worth of requests completes. It is halved when a request is rate limited, and cut by a tenth when slowdown climbs past tolerance, at most once for each round of requests started before the last cut."""
+	def __init__(self, initial, minimum = 1, maximum = 32, tolerance = 2.0, window = 500):
+		self.minimum = minimum
+		self.maximum = max(maximum, minimum)
+		self.limit = float(min(max(initial, minimum), self.maximum))
+		self.tolerance = tolerance
+		self.window = window
+		self.sizes = {}
+		self.samples = 0
+		self.reserved = 0
+		self.busy = 0
+		self.changed = asyncio.Event()
+		self.slowdown = None
+		self.last_decrease = 0.0
+		self.rate_limited = 0
+	@property
+	def current(self):
+		return int(self.limit)
+	async def acquire(self):
+		"""Waits until fewer requests than the limit are running and reserves a place for another."""
+		while self.reserved >= self.current:
+			self.changed.clear()
+			await self.changed.wait()
+		self.reserved += 1
+	def release(self):
+		self.reserved -= 1
+		self.changed.set()
+	def begin(self):
+		"""Called when a reserved place starts work on a request, returning a tuple of the start time and whether the limit is fully used to pass to end."""
+		self.busy += 1
+		return time.monotonic(), self.busy >= self.current
+	def end(self, started, saturated, outcome = None, rate_limited = False, size = 0):
+		"""Adjusts the limit from the outcome of a request of size characters, which is None if it succeeded, it's error message if it failed or False if it was canceled. Canceled requests and errors other than rate limiting leave the limit alone. Returns True if the whole number of requests allowed at once changed."""
+		self.busy -= 1
+		before = self.current
+		if rate_limited:
+			self.rate_limited += 1
+			self.decrease(started, 0.5)
+		elif outcome is None:
+			ratio = self.compare_latency(size.bit_length(), time.monotonic() - started)
+			self.slowdown = ratio if self.slowdown is None else self.slowdown * 0.8 + ratio * 0.2
+			if self.slowdown > self.tolerance: self.decrease(started, 0.9)
+			elif saturated: self.limit = min(self.limit + 1 / self.limit, self.maximum)
+		return self.current != before
+	def compare_latency(self, size, latency):
+		"""Records a latency for a request in a size class, returning how many times slower it was than the quickest recent request of that size."""
+		quickest, previous_quickest = self.sizes.get(size, (math.inf, math.inf))
+		self.sizes[size] = (min(quickest, latency), previous_quickest)
+		baseline = min(quickest, previous_quickest, latency)
+		self.samples += 1
+		if self.samples % self.window == 0: self.sizes = {s: (math.inf, q) for s, (q, p) in self.sizes.items()}
+		return latency / baseline if baseline > 0 else 1.0
+	def decrease(self, started, factor):
+		if started < self.last_decrease: return
+		self.limit = max(self.limit * factor, self.minimum)
+		self.last_decrease = time.monotonic()
+	def report(self):
+		slowdown = f"{self.slowdown:.2f} times the quickest for lines of similar length" if self.slowdown is not None else "not measured yet"
+		line = f"concurrency limit {self.limit:.1f} of {self.maximum}, {self.busy} busy, latency {slowdown}, {self.rate_limited} rate limited"
+		self.rate_limited = 0
+		return line
+
 class star_provider:
 	"""A base class that can be used to implement any STAR provider able to be written in Python3. It abstracts all communication with coagulators, as much of the async stuff as possible, filtering voice names and more."""
-	def __init__(self, provider_basename = os.path.splitext(sys.argv[0])[0], handle_argv = True, run_immedietly = True, voices = None, synthesis_process = None, synthesis_process_rate = None, synthesis_process_pitch = None, synthesis_default_rate = None, synthesis_default_pitch = None, synthesis_audio_extension = None):
+	adaptive_concurrency = False # Providers backed by rate limited web APIs set this to True so that the number of concurrent requests adapts to the API by default, see concurrency_limit.
+	def __init__(self, provider_basename = os.path.splitext(sys.argv[0])[0], handle_argv = True, run_immedietly = True, voices = None, synthesis_process = None, synthesis_process_rate = None, synthesis_process_pitch = None, synthesis_default_rate = None, synthesis_default_pitch = None, synthesis_audio_extension = None, synthesis_worker = None):
 		"""The provider_basename argument should be set to a simple strings such as balcony or pyttsx. Set handle_argv to False if you don't wish for the default CLI interface. If you really wish to configure this object further than the constructor allows before running the provider, set run_immedietly to False. The default implementation makes it easy to implement executable based providers with  the synthesis_process arguments."""
 		self.config_filename = f"{provider_basename}.ini"
 		self.basename = provider_basename
@@ -115,6 +280,7 @@ class star_provider:
 		if synthesis_process: self.synthesis_process = synthesis_process
 		if synthesis_process_rate: self.synthesis_process_rate = synthesis_process_rate
 		if synthesis_process_pitch: self.synthesis_process_pitch = synthesis_process_pitch
+		if synthesis_worker: self.synthesis_worker = synthesis_worker
 		self.synthesis_default_rate = synthesis_default_rate
 		self.synthesis_default_pitch = synthesis_default_pitch
 		self.synthesis_audio_extension = synthesis_audio_extension
@@ -123,7 +289,16 @@ class star_provider:
 		if not hasattr(self, "hosts"): self.hosts = self.config.get("hosts", ["ws://localhost:7774"])
 		if type(self.hosts) == str: self.hosts = [self.hosts]
 		self.read_configuration_options()
+		self.ffmpeg = self.config.get("ffmpeg_path", "") or shutil.which("ffmpeg")
+		self.encode_formats = self.config.get("encode_formats", list(audio_encoders))
+		if type(self.encode_formats) == str: self.encode_formats = [self.encode_formats]
 		self.canceled_requests = set()
+		self.workers = set()
+		self.idle_workers = []
+		self.connections = set()
+		self.concurrency = None
+		self.synthesis_temp_dir = self.config.get("synthesis_temp_dir", "") or None
+		self.temp_file_prefix = f"star_{os.path.basename(self.basename)}_"
 		if run_immedietly: self.run()
 	def handle_argv(self):
 		p = argparse.ArgumentParser(argument_default = argparse.SUPPRESS)
@@ -152,25 +327,52 @@ class star_provider:
 			self.voices[id].update({"id": id, "full_name": self.voices[id]["full_name"] if "full_name" in self.voices[id] else k, "label": conf["alias"] if "alias" in conf else id, "enabled": conf.as_bool("enabled") if "enabled" in conf else True})
 			if "alias" in conf: self.voices[id]["alias"] = conf["alias"]
 	async def synthesize(self, voice, text, rate = None, pitch = None):
-		"""Synthesizes some text, should return a bytes object containing the audio data (usually a playable wav file or other common audio format), otherwise a string with an error message. The default implementation uses the executable and arguments defined by self.synthesis_process, allowing any providers that use external applications to be implemented almost instantly!"""
+		"""Synthesizes some text, should return a bytes object containing the audio data (usually a playable wav file or other common audio format), otherwise a string with an error message. Providers that can stream may instead return or be an async iterator of bytes chunks, which are relayed to users as they are produced (a string yielded by the iterator is an error). The default implementation uses the executable and arguments defined by self.synthesis_process, allowing any providers that use external applications to be implemented almost instantly! If no argument of the process contains {filename}, audio is instead streamed from the process's standard output. Engines that can synthesize many lines from one process should set self.synthesis_worker instead, see the synthesis_worker class."""
+		if hasattr(self, "synthesis_worker"): return await self.synthesize_with_worker(voice, text, rate, pitch)
 		if not hasattr(self, "synthesis_process"): return f"no method provided for synthesis of {voice}"
+		filename = process = None
 		try:
-			with tempfile.NamedTemporaryFile(suffix=f".{self.synthesis_audio_extension if self.synthesis_audio_extension else 'wav'}", delete=False) as fp:
-				fp.close()
+			if any("{filename}" in arg for arg in self.synthesis_process):
+				fd, filename = tempfile.mkstemp(prefix = self.temp_file_prefix, suffix = f".{self.synthesis_audio_extension if self.synthesis_audio_extension else 'wav'}", dir = self.synthesis_temp_dir)
+				os.close(fd)
 			args = []
-			for arg in self.synthesis_process: args.append(arg.format(voice = voice, text = text.replace("\"", " "), rate = rate if rate is not None else 0, pitch = pitch if pitch is not None else 0, filename = fp.name))
+			for arg in self.synthesis_process: args.append(arg.format(voice = voice, text = text.replace("\"", " "), rate = rate if rate is not None else 0, pitch = pitch if pitch is not None else 0, filename = filename or ""))
 			if rate is not None and hasattr(self, "synthesis_process_rate"):
 				for arg in self.synthesis_process_rate: args.append(arg.format(rate = rate))
 			if pitch is not None and hasattr(self, "synthesis_process_pitch"):
 				for arg in self.synthesis_process_pitch: args.append(arg.format(pitch = pitch))
+			if not filename: return self.synthesis_process_output(args)
 			process = await asyncio.create_subprocess_exec(*args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, creationflags = subprocess.CREATE_NO_WINDOW if sys.platform == "win32" else 0)
 			await process.communicate()
-			audio_data = b""
-			with open(fp.name, "rb") as f: audio_data = f.read()
-			os.unlink(fp.name)
-			return audio_data
+			with open(filename, "rb") as f: audio_data = f.read()
+			return audio_data if audio_data else f"{args[0]} exited with code {process.returncode} without producing audio"
 		except Exception as e:
 			return str(e)
+		finally:
+			# The temporary file must not outlive the request, even if the engine crashed or the request was canceled while it was running.
+			if process and process.returncode is None: process.kill()
+			if filename:
+				try: os.unlink(filename)
+				except OSError: pass
+	def remove_stale_temp_files(self):
+		"""Deletes audio files that synthesis processes left in the temporary directory during a previous run of this provider which was killed before it could clean up. Only files more than an hour old are touched, in case another copy of the provider is running."""
+		directory = self.synthesis_temp_dir or tempfile.gettempdir()
+		try:
+			for name in os.listdir(directory):
+				path = os.path.join(directory, name)
+				if name.startswith(self.temp_file_prefix) and os.path.getmtime(path) < time.time() - 3600: os.unlink(path)
+		except OSError: pass
+	async def synthesis_process_output(self, args):
+		"""Runs a synthesis process that writes it's audio to standard output, yielding the audio as the process produces it."""
+		process = await asyncio.create_subprocess_exec(*args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, creationflags = subprocess.CREATE_NO_WINDOW if sys.platform == "win32" else 0)
+		try:
+			produced_audio = False
+			while chunk := await process.stdout.read(65536):
+				produced_audio = True
+				yield chunk
+			if await process.wait() and not produced_audio: yield f"{args[0]} exited with code {process.returncode}"
+		finally:
+			if process.returncode is None: process.kill()
 	async def connect(self, host):
 		should_exit = False
 		last_exception = ""
@@ -179,14 +381,18 @@ class star_provider:
 				async with websockets.asyncio.client.connect(host, max_size = None, max_queue = 4096) as websocket:
 					connected_voices = await self.send_voices(websocket)
 					print(f"Connected {connected_voices} voices to {host}.")
-					while True:
-						message = await websocket.recv()
-						try:
-							event = json.loads(message)
-							if "abort" in event: self.canceled_requests.add(event["abort"])
-							else: await self.task_queue.put((websocket, event))
-						except json.JSONDecodeError:
-							print("Received an invalid JSON message:", message)
+					self.connections.add(websocket)
+					try:
+						while True:
+							message = await websocket.recv()
+							try:
+								event = json.loads(message)
+								if type(event.get("trace")) == dict: event["trace"]["provider_receive"] = time.time()
+								if "abort" in event: self.canceled_requests.add(event["abort"])
+								else: await self.queue_task(websocket, event, host)
+							except json.JSONDecodeError:
+								print("Received an invalid JSON message:", message)
+					finally: self.connections.discard(websocket)
 			except KeyboardInterrupt:
 				print("shutting down")
 				should_exit = True
@@ -198,42 +404,180 @@ class star_provider:
 				last_exception = exc
 				time.sleep(3)
 	async def send_voices(self, websocket):
-		"""Send a list of voice names to the server."""
-		packet = {"provider": PROVIDER_REVISION, "provider_name": self.basename, "voices": []}
+		"""Send a list of voice names to the server, along with the number of requests we can work on at once so that the coagulator holds back the rest until we finish some."""
+		packet = {"provider": PROVIDER_REVISION, "provider_name": self.basename, "window": self.concurrency.current if self.concurrency else self.concurrent_requests, "voices": []}
 		for v in self.voices:
 			if not self.voices[v]["enabled"]: continue
 			packet["voices"].append(self.voices[v]["label"])
 		await websocket.send(json.dumps(packet))
 		return len(packet["voices"])
+	async def send_window(self):
+		"""Tells every connected coagulator how many requests we can now work on at once, after the adaptive concurrency limit changed."""
+		packet = json.dumps({"provider": PROVIDER_REVISION, "window": self.concurrency.current})
+		for websocket in list(self.connections):
+			try: await websocket.send(packet)
+			except websockets.ConnectionClosed: pass
+	def is_rate_limited(self, error):
+		"""Returns True if an error message returned by synthesize means that the speech service is rate limiting or is overloaded, so that adaptive concurrency backs off. The default matches the wording of common HTTP 429 and throttling errors, and providers whose services word it differently can override this."""
+		return bool(rate_limit_pattern.search(error))
 	async def process_remote_event(self, websocket, event):
-		"""Receives a JSON payload from the coagulator and processes it, sending back either synthesized audio or an error payload."""
+		"""Receives a JSON payload from the coagulator and processes it, sending back either synthesized audio or an error payload, and returns the error message if synthesis failed or False if the request was canceled. If the payload contains a trace, the times at which we started working on it, started and finished synthesis and sent the audio are added to it and returned with the audio."""
 		try:
 			if "voice" in event and "text" in event:
 				if event["id"] in self.canceled_requests:
 					self.canceled_requests.remove(event["id"])
-					return
+					return False
+				trace = event["trace"] if type(event.get("trace")) == dict else None
+				if trace is not None: trace["provider_dequeue"] = trace["synthesis_start"] = time.time()
 				synthesis_result = None
 				synthesis_args = (self.voices[event["voice"]]["full_name"], event["text"], event["rate"] if "rate" in event else self.synthesis_default_rate, event["pitch"] if "pitch" in event else self.synthesis_default_pitch)
 				if not event["voice"] in self.voices: synthesis_result = f"cannot find voice {event['voice']}"
-				else: synthesis_result = await self.synthesize(*synthesis_args) if asyncio.iscoroutinefunction(self.synthesize) else self.synthesize(*synthesis_args)
+				elif asyncio.iscoroutinefunction(self.synthesize): synthesis_result = await self.synthesize(*synthesis_args)
+				elif inspect.isasyncgenfunction(self.synthesize): synthesis_result = self.synthesize(*synthesis_args)
+				else: synthesis_result = await self.run_blocking(self.synthesize, *synthesis_args)
 				meta = {"id": event["id"]}
 				if self.synthesis_audio_extension: meta["extension"] = self.synthesis_audio_extension
+				if hasattr(synthesis_result, "__aiter__"):
+					if event.get("stream", False): return await self.send_audio_stream(websocket, event, meta, synthesis_result)
+					chunks = [chunk async for chunk in synthesis_result]
+					synthesis_result = next((chunk for chunk in chunks if type(chunk) == str), None) or b"".join(chunks)
+				if trace is not None: trace["synthesis_end"] = time.time()
+				if type(synthesis_result) == bytes and synthesis_result[:4] == b"RIFF" and type(event.get("formats")) == list:
+					format = next((f for f in event["formats"] if f in self.encode_formats and f in audio_encoders), None)
+					encoded = await self.encode_audio(synthesis_result, format) if format and self.ffmpeg else None
+					if encoded: synthesis_result, meta["extension"] = encoded, format
+				if trace is not None:
+					trace["provider_send"] = time.time()
+					meta["trace"] = trace
 				meta = json.dumps(meta)
-				if type(synthesis_result) == str: await websocket.send(json.dumps({"provider": PROVIDER_REVISION, "id": event["id"], "status": synthesis_result, "abort": True}))
-				else: await websocket.send(len(meta).to_bytes(2, "little") + meta.encode() + synthesis_result)
+				if type(synthesis_result) == str:
+					await websocket.send(json.dumps({"provider": PROVIDER_REVISION, "id": event["id"], "status": synthesis_result, "abort": True}))
+					return synthesis_result
+				await websocket.send(len(meta).to_bytes(2, "little") + meta.encode() + synthesis_result)
 		except Exception as e:
 			traceback.print_exc()
 			await websocket.send(json.dumps({"provider": PROVIDER_REVISION, "id": event["id"], "status": f"exception during synthesis {e}", "abort": True}))
+			return str(e)
+	async def send_audio_stream(self, websocket, event, meta, chunks):
+		"""Sends audio to the coagulator as it is synthesized, in binary packets whose metadata contains a chunk sequence number, followed by an empty packet marked final. Streaming stops early if the request is aborted."""
+		sequence = 0
+		async for chunk in chunks:
+			if type(chunk) == str:
+				await websocket.send(json.dumps({"provider": PROVIDER_REVISION, "id": event["id"], "status": chunk, "abort": True}))
+				return chunk
+			if event["id"] in self.canceled_requests:
+				self.canceled_requests.remove(event["id"])
+				if hasattr(chunks, "aclose"): await chunks.aclose()
+				return False
+			if not chunk: continue
+			chunk_meta = json.dumps({**meta, "chunk": sequence})
+			await websocket.send(len(chunk_meta).to_bytes(2, "little") + chunk_meta.encode() + chunk)
+			sequence += 1
+		if type(event.get("trace")) == dict:
+			event["trace"]["synthesis_end"] = event["trace"]["provider_send"] = time.time()
+			meta["trace"] = event["trace"]
+		meta = json.dumps({**meta, "chunk": sequence, "final": True})
+		await websocket.send(len(meta).to_bytes(2, "little") + meta.encode())
+	async def encode_audio(self, audio, format):
+		"""Compresses wav audio into one of the formats in audio_encoders with ffmpeg, for coagulators that say the user can play it. Returns None if that fails so that the wav can be sent instead."""
+		args = [arg.format(opus_bitrate = self.config.get("opus_bitrate", "32k")) for arg in audio_encoders[format]]
+		try:
+			process = await asyncio.create_subprocess_exec(self.ffmpeg, "-loglevel", "error", "-i", "pipe:0", *args, "pipe:1", stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, creationflags = subprocess.CREATE_NO_WINDOW if sys.platform == "win32" else 0)
+			encoded, _ = await process.communicate(audio)
+		except OSError: return None
+		return encoded if process.returncode == 0 and encoded else None
+	async def synthesize_with_worker(self, voice, text, rate = None, pitch = None):
+		"""Synthesizes a line on one of the provider's synthesis worker processes. A worker that dies, stops answering within synthesis_worker_timeout seconds or breaks the protocol is killed, and the line is tried once more on a fresh worker if the old one died. So is a worker whose line is canceled or fails in any other way, as it may still be part way through the line and can't be given another. Workers only become idle again once they have answered cleanly, and are replaced after synthesis_worker_max_requests lines in case the engine leaks."""
+		for attempt in range(2):
+			worker = None
+			try:
+				worker = await self.acquire_worker(voice)
+				audio = await worker.synthesize(voice, text, rate, pitch, float(self.config.get("synthesis_worker_timeout", 60)))
+			except (OSError, ValueError, KeyError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+				if worker: self.stop_worker(worker)
+				if attempt or not isinstance(e, (OSError, asyncio.IncompleteReadError)): return f"synthesis worker failed, {e}"
+				continue
+			except BaseException:
+				if worker: self.stop_worker(worker)
+				raise
+			if worker.requests >= int(self.config.get("synthesis_worker_max_requests", 1000)): self.stop_worker(worker)
+			else: self.idle_workers.append(worker)
+			return audio
+	async def acquire_worker(self, voice):
+		"""Returns an idle synthesis worker for the given voice, preferring one that last synthesized it so that the engine already has the voice loaded. If the worker command contains {voice}, each worker is started for a single voice and only used for that voice. A new worker is started when there is no suitable idle one, first stopping the least recently used idle worker if all concurrent_requests workers are running."""
+		for worker in [w for w in self.idle_workers if not w.alive]:
+			self.idle_workers.remove(worker)
+			self.stop_worker(worker)
+		per_voice = any("{voice}" in arg for arg in self.synthesis_worker)
+		worker = next((w for w in reversed(self.idle_workers) if w.voice == voice), None)
+		if not worker and not per_voice and self.idle_workers: worker = self.idle_workers[-1]
+		if worker:
+			self.idle_workers.remove(worker)
+			return worker
+		if len(self.workers) >= self.concurrent_requests and self.idle_workers: self.stop_worker(self.idle_workers.pop(0))
+		return await self.start_worker(voice if per_voice else None)
+	async def start_worker(self, voice = None):
+		worker = synthesis_worker([arg.format(voice = voice) for arg in self.synthesis_worker] if voice else self.synthesis_worker, voice)
+		try: await worker.start()
+		except BaseException:
+			worker.kill()
+			raise
+		self.workers.add(worker)
+		return worker
+	def stop_worker(self, worker):
+		worker.kill()
+		self.workers.discard(worker)
+	async def run_blocking(self, func, *args, **kwargs):
+		"""Runs a blocking function on the provider's thread pool and returns it's result, so that the event loop is free while it runs. Synthesize implementations that aren't coroutines are run this way automatically. The pool has a thread for each concurrent request unless the synthesis_threads setting says otherwise, and setting it to 0 runs blocking functions directly on the event loop as older versions did."""
+		if not self.thread_executor: return func(*args, **kwargs)
+		return await asyncio.get_running_loop().run_in_executor(self.thread_executor, functools.partial(func, *args, **kwargs))
+	async def run_in_process(self, func, *args):
+		"""Runs a CPU bound function in a separate process and returns it's result, for work such as pure python synthesis that would otherwise hold python's global interpreter lock and slow down every other request. The function and it's arguments must be picklable, so a module level function rather than a method. There are synthesis_processes worker processes, and if that setting is 0 (the default) the function is run on the thread pool instead."""
+		if not self.process_executor: return await self.run_blocking(func, *args)
+		return await asyncio.get_running_loop().run_in_executor(self.process_executor, func, *args)
+	async def queue_task(self, websocket, event, host = None):
+		"""Adds a speech request received from a coagulator to the task scheduler, under the host it was received from if given."""
+		self.scheduler.put(host or websocket, websocket, event)
 	async def handle_task_queue(self):
+		"""Works on one request from the scheduler at a time for the life of the provider. There is one of these for each concurrent request, or with adaptive concurrency one for the most concurrent requests allowed, each waiting for a place within the current limit before taking a request."""
 		while True:
-			event = await self.task_queue.get()
-			await self.process_remote_event(*event)
-			self.task_queue.task_done()
+			if self.concurrency: await self.concurrency.acquire()
+			try:
+				websocket, event, expired = await self.scheduler.get()
+				if expired or event.get("id") in self.canceled_requests: self.canceled_requests.discard(event.get("id"))
+				elif not self.concurrency: await self.process_remote_event(websocket, event)
+				else:
+					started, saturated = self.concurrency.begin()
+					outcome = await self.process_remote_event(websocket, event)
+					if self.concurrency.end(started, saturated, outcome, type(outcome) == str and self.is_rate_limited(outcome), len(str(event.get("text", "")))): await self.send_window()
+			finally:
+				if self.concurrency: self.concurrency.release()
+	async def report_queue_stats(self, interval):
+		"""Prints the scheduler's queue depths and waiting times every interval seconds, along with the adaptive concurrency limit if there is one, which helps with tuning the concurrent_requests setting."""
+		while True:
+			await asyncio.sleep(interval)
+			for line in self.scheduler.report(): print(line)
+			if self.concurrency: print(self.concurrency.report())
 	async def async_main(self):
 		await self.ready_voices()
 		if hasattr(self, "do_configuration_interface"): return self.configuration_interface()
-		self.task_queue = asyncio.LifoQueue()
-		for i in range(int(self.config.get("concurrent_requests", multiprocessing.cpu_count() / 2))): asyncio.create_task(self.handle_task_queue())
+		self.scheduler = task_scheduler()
+		if hasattr(self, "synthesis_process"): self.remove_stale_temp_files()
+		self.concurrent_requests = max(int(self.config.get("concurrent_requests", multiprocessing.cpu_count() / 2)), 1)
+		if self.config.as_bool("adaptive_concurrency") if "adaptive_concurrency" in self.config else self.adaptive_concurrency: self.concurrency = concurrency_limit(self.concurrent_requests, maximum = max(int(self.config.get("max_concurrent_requests", 32)), self.concurrent_requests))
+		task_handlers = self.concurrency.maximum if self.concurrency else self.concurrent_requests
+		if not hasattr(self, "thread_executor"):
+			threads = int(self.config.get("synthesis_threads", task_handlers))
+			processes = int(self.config.get("synthesis_processes", 0))
+			self.thread_executor = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix = self.basename) if threads > 0 else None
+			self.process_executor = concurrent.futures.ProcessPoolExecutor(processes) if processes > 0 else None
+		if hasattr(self, "synthesis_worker") and not any("{voice}" in arg for arg in self.synthesis_worker) and not self.workers:
+			try:
+				for i in range(self.concurrent_requests): self.idle_workers.append(await self.start_worker())
+			except OSError as e: print(f"failed to start synthesis workers, {e}")
+		for i in range(task_handlers): asyncio.create_task(self.handle_task_queue())
+		queue_stats_interval = float(self.config.get("queue_stats_interval", 0))
+		if queue_stats_interval > 0: asyncio.create_task(self.report_queue_stats(queue_stats_interval))
 		await asyncio.gather(*[self.connect(host) for host in self.hosts])
 	def run(self):
 		while True:
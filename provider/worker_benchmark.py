@@ -0,0 +1,102 @@
+# Compares the per-line latency of the two ways star_provider can drive a command line speech engine: starting the engine once for every line with synthesis_process, or keeping engine processes running with synthesis_worker.
+# The engine is simulated by this same script, which sleeps for --startup seconds when it starts (standing in for loading the engine and it's voice) and for --synthesis seconds per line before producing a short wav file, so the numbers show how much of a real engine's start up cost the worker mode saves.
+# With --check it instead checks that workers are never leaked or reused part way through a line, by having the simulated engine crash or hang on some lines and canceling others while they are synthesized. The exit status is nonzero if any worker is left behind.
+# The provider class needs it's usual requirements (including wxPython) to be installed. For example: python worker_benchmark.py --lines 50 --startup 0.3
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import wave
+from provider import star_provider
+
+def fake_audio(text):
+	f = io.BytesIO()
+	with wave.open(f, "wb") as w:
+		w.setnchannels(1)
+		w.setsampwidth(2)
+		w.setframerate(16000)
+		w.writeframes(bytes(len(text) * 640))
+	return f.getvalue()
+
+def run_engine(args):
+	"""The simulated engine, which either writes a single line given on it's command line to a file or, with --worker, speaks the synthesis_worker protocol on it's standard input and output."""
+	time.sleep(args.startup)
+	if not args.worker:
+		time.sleep(args.synthesis)
+		with open(args.filename, "wb") as f: f.write(fake_audio(" ".join(args.text)))
+		return
+	for line in sys.stdin:
+		request = json.loads(line)
+		if request["text"] == "crash": os._exit(1)
+		if request["text"] == "hang": time.sleep(3600)
+		time.sleep(args.synthesis)
+		audio = fake_audio(request["text"])
+		sys.stdout.buffer.write(json.dumps({"length": len(audio)}).encode() + b"\n" + audio)
+		sys.stdout.buffer.flush()
+
+async def measure(provider, lines):
+	"""Synthesizes lines one after another, returning the seconds each took."""
+	await provider.ready_voices()
+	provider.concurrent_requests = 1
+	times = []
+	for i in range(lines):
+		start = time.perf_counter()
+		audio = await provider.synthesize("bench", f"line number {i}")
+		if type(audio) == str: sys.exit(audio)
+		times.append(time.perf_counter() - start)
+	for worker in list(provider.workers): provider.stop_worker(worker)
+	return times
+
+async def check(provider):
+	"""Synthesizes lines that succeed, crash the engine, hang it past synthesis_worker_timeout and are canceled part way through, checking after each that every worker still running is idle and alive and that a normal line still works."""
+	await provider.ready_voices()
+	provider.concurrent_requests = 2
+	provider.config["synthesis_worker_timeout"] = "1"
+	failures = 0
+	async def canceled():
+		task = asyncio.create_task(provider.synthesize("bench", "hang"))
+		await asyncio.sleep(0.5)
+		task.cancel()
+		try: await task
+		except asyncio.CancelledError: return "canceled"
+	for name, scenario in [("line", lambda: provider.synthesize("bench", "hello")), ("crash", lambda: provider.synthesize("bench", "crash")), ("hang", lambda: provider.synthesize("bench", "hang")), ("cancel", canceled)]:
+		result = await scenario()
+		await asyncio.sleep(0.1)
+		leaked = [w for w in provider.workers if w not in provider.idle_workers or not w.alive]
+		after = await provider.synthesize("bench", "hello")
+		ok = not leaked and type(after) == bytes and (type(result) == bytes) == (name == "line")
+		failures += not ok
+		print(f"{name}: {'ok' if ok else 'failed'}, {type(result).__name__} result, {len(provider.workers)} workers, {len(leaked)} busy or dead")
+	for worker in list(provider.workers): provider.stop_worker(worker)
+	return failures
+
+def report(name, times):
+	times = sorted(times)
+	print(f"{name}: mean {sum(times) / len(times) * 1000:.1f}ms, p50 {times[len(times) // 2] * 1000:.1f}ms, max {times[-1] * 1000:.1f}ms per line")
+
+def main():
+	p = argparse.ArgumentParser(description = "Measures per-line latency of one-shot synthesis processes against persistent synthesis workers.")
+	p.add_argument("--lines", type = int, default = 30)
+	p.add_argument("--startup", type = float, default = 0.2, help = "seconds the simulated engine takes to start")
+	p.add_argument("--synthesis", type = float, default = 0.02, help = "seconds the simulated engine takes to synthesize each line")
+	p.add_argument("--check", action = "store_true", help = "check that workers are cleaned up after crashes, hangs and cancellation instead of measuring latency")
+	p.add_argument("--engine", action = "store_true", help = argparse.SUPPRESS)
+	p.add_argument("--worker", action = "store_true", help = argparse.SUPPRESS)
+	p.add_argument("filename", nargs = "?", help = argparse.SUPPRESS)
+	p.add_argument("text", nargs = "*", help = argparse.SUPPRESS)
+	args = p.parse_args()
+	if args.engine: return run_engine(args)
+	engine = [sys.executable, os.path.abspath(__file__), "--engine", "--startup", str(args.startup), "--synthesis", str(args.synthesis)]
+	basename = os.path.join(tempfile.mkdtemp(prefix = "star_worker_"), "worker_benchmark")
+	oneshot = star_provider(basename, handle_argv = False, run_immedietly = False, voices = "bench", synthesis_process = engine + ["{filename}", "{text}"])
+	worker = star_provider(basename, handle_argv = False, run_immedietly = False, voices = "bench", synthesis_worker = engine + ["--worker"])
+	if args.check: sys.exit(asyncio.run(check(worker)))
+	report("process per line", asyncio.run(measure(oneshot, args.lines)))
+	report("synthesis worker", asyncio.run(measure(worker, args.lines)))
+
+if __name__ == "__main__": main()
@@ -1,6 +1,7 @@
 import accessible_output2.outputs.auto
 import atexit
 import configobj
+import csv
 import ctypes
 import glob
 import json
@@ -9,6 +10,10 @@ from pydub import AudioSegment
 from smart_list import SmartList, Column, VirtualSmartList
 from sound_lib.main import BassError
 from sound_lib import output, stream
+try:
+	from sound_lib.external import pybassflac, pybassopus # Registering these BASS plugins lets compressed audio from providers play like any other file.
+	compressed_audio_formats = ["flac", "opus"]
+except Exception: compressed_audio_formats = []
 import subprocess
 import sys
 import tempfile
@@ -64,6 +69,56 @@ class playsound:
 		except BassError: return
 		if self.handle: self.finish_func(self)
 
+class playstream(playsound):
+	"""Plays a wav file that arrives in pieces, such as speech that a provider is streaming while it is still being synthesized. Pass each piece to push as it arrives and call end once the file is complete. Only 16 bit PCM audio can be streamed, for anything else the streamable attribute becomes False and the complete file should be played with playsound instead."""
+	def __init__(self, finish_func = None):
+		self.handle = None
+		self.header = b""
+		self.streamable = True
+		self.ended = False
+		self.finish_func = finish_func
+	def push(self, data):
+		if not self.streamable: return
+		if self.header is None:
+			if self.handle: self.handle.push(data)
+			return
+		self.header += data
+		offset = self.parse_header()
+		if offset is None: self.streamable = False
+		if not offset: return
+		data = self.header[offset:]
+		self.header = None
+		if data: self.handle.push(data)
+		self.handle.play()
+		if self.finish_func: threading.Thread(target = self.wait_for_finish, daemon = True).start()
+		playing_sounds.append(self)
+	def parse_header(self):
+		"""Walks the chunks of the wav header received so far, creating the push stream and returning the offset of the first sample once the data chunk is reached. Returns 0 if more of the file is needed, or None if it cannot be streamed."""
+		h = self.header
+		if len(h) < 12: return 0
+		if h[:4] != b"RIFF" or h[8:12] != b"WAVE": return None
+		pos = 12
+		fmt = None
+		while pos + 8 <= len(h):
+			chunk_id = h[pos:pos + 4]
+			size = int.from_bytes(h[pos + 4:pos + 8], "little")
+			if chunk_id == b"data":
+				if not fmt or fmt[0] != 1 or fmt[3] != 16: return None
+				self.handle = stream.PushStream(freq = fmt[2], chans = fmt[1])
+				return pos + 8
+			if pos + 8 + size > len(h): return 0
+			if chunk_id == b"fmt " and size >= 16: fmt = (int.from_bytes(h[pos + 8:pos + 10], "little"), int.from_bytes(h[pos + 10:pos + 12], "little"), int.from_bytes(h[pos + 12:pos + 16], "little"), int.from_bytes(h[pos + 22:pos + 24], "little"))
+			pos += 8 + size + (size & 1)
+		return 0
+	def end(self):
+		self.ended = True
+	def wait_for_finish(self):
+		# A push stream stalls rather than stopping when it plays everything received so far, so it is only finished once it has ended and drained.
+		try:
+			while self.finish_func and self.handle and (not self.ended or self.handle.is_playing or self.handle.is_paused): time.sleep(0.005)
+		except BassError: return
+		if self.handle: self.finish_func(self)
+
 def is_valid_ws_uri(uri):
 	"""Helper function to insure a provided host is a valid websocket URI. Returns either True or an error string."""
 	if not uri: return "must not be empty"
@@ -98,9 +153,30 @@ class speech_request:
 		self.timestamp = time.time()
 		self.textline = textline
 		self.render_filename = render_filename
+		self.chunks = []
+		self.stream = None
+		self.formats = []
 		self.request_id = str(speech_request.next_request_id)
 		speech_request.next_request_id += 1
 
+def trace_stages(trace, sent, received):
+	"""Given the trace from a clip's metadata and the times we sent the request and received the clip, returns a dictionary of the seconds spent in each stage of the request's journey that the trace has timestamps for. Each stage is measured between timestamps taken on the same machine, so network stages are round trips with the time spent on the far side taken out."""
+	spans = {
+		"total": [("received", "sent")],
+		"client_network": [("received", "sent"), ("coagulator_receive", "coagulator_relay")],
+		"coagulator_queue": [("coagulator_dispatch", "coagulator_receive")],
+		"provider_network": [("coagulator_response", "coagulator_dispatch"), ("provider_receive", "provider_send")],
+		"provider_queue": [("provider_dequeue", "provider_receive")],
+		"synthesis": [("synthesis_end", "synthesis_start")],
+		"provider_other": [("provider_send", "provider_receive"), ("provider_dequeue", "provider_receive"), ("synthesis_start", "synthesis_end")],
+	}
+	times = {**trace, "sent": sent, "received": received}
+	stages = {}
+	for stage, pairs in spans.items():
+		try: stages[stage] = max(sum(float(times[a]) - float(times[b]) for a, b in pairs), 0.0)
+		except (KeyError, TypeError, ValueError): continue
+	return stages
+
 render_filename_tokens = [
 	*[(f"counter{'0' * (i + 1)}", f"A counter in the format {', '.join([str(x).zfill(i + 1) for x in range(3)])}...", lambda render, i = i: str(render.counter -1).zfill(i + 1)) for i in range(4)],
 	*[(f"counter{'0' * i}1", f"A counter in the format {', '.join([str(x + 1).zfill(i + 1) for x in range(3)])}...", lambda render, i = i: str(render.counter).zfill(i + 1)) for i in range(4)],
@@ -232,6 +308,12 @@ class star_client_configuration(wx.Dialog):
 		self.clear_output_on_render = wx.CheckBox(self, label = "Clear Output &subdirectory on render")
 		self.clear_output_on_render.Value = config.as_bool("clear_output_on_render") if "clear_output_on_render" in config else True
 		sizer.Add(self.clear_output_on_render, 0, wx.ALL, 5)
+		self.lossy_audio = wx.CheckBox(self, label = "Accept &lossy compressed audio for previews to save bandwidth")
+		self.lossy_audio.Value = config.as_bool("lossy_audio") if "lossy_audio" in config else False
+		sizer.Add(self.lossy_audio, 0, wx.ALL, 5)
+		self.render_trace = wx.CheckBox(self, label = "Write a &timing trace file with each render")
+		self.render_trace.Value = config.as_bool("render_trace") if "render_trace" in config else False
+		sizer.Add(self.render_trace, 0, wx.ALL, 5)
 		self.clear_cache_btn = wx.Button(self, label = "&Clear audio cache")
 		self.clear_cache_btn.Bind(wx.EVT_BUTTON, self.on_clear_cache)
 		self.clear_cache_btn.Enabled = hasattr(parent, "speech_cache") and len(parent.speech_cache) > 0
@@ -355,6 +437,7 @@ class star_client(wx.Frame):
 		self.connecting_panel.Show()
 		self.connecting_label.SetFocus()
 		self.voices = []
+		self.voices_version = 0
 		self.voice_find_text = ""
 		self.speech_requests = {}
 		self.speech_requests_text = {}
@@ -547,6 +630,7 @@ class star_client(wx.Frame):
 		self.render_progress.Value = 0
 		self.render_progress.Show()
 		self.last_renderable_lines = renderable_lines
+		self.render_traces = [] if "render_trace" in config and config.as_bool("render_trace") else None
 		for l in renderable_lines:
 			if not self.render_total: return # render canceled
 			self.audiospeak(l[1], render_filename = l[0])
@@ -567,10 +651,22 @@ class star_client(wx.Frame):
 				output_basedir = os.path.split(self.render_path)[0]
 				if not os.path.isdir(output_basedir): os.makedirs(output_basedir)
 				combined.export(self.render_path, format = os.path.splitext(title)[1].lower()[1:], bitrate = "192k")
+			if self.render_traces: self.write_render_trace(os.path.splitext(self.render_path)[0] + "_trace.csv" if os.path.splitext(title)[1] in [".wav", ".mp3"] else os.path.join(self.render_output_path, "trace.csv"))
 		if hasattr(self, "render_output_path_tmp"): del(self.render_output_path_tmp)
 		self.render_btn.Label = "&Render to Disc"
 		playsound("audio/complete.ogg" if not canceled else "audio/cancel.ogg")
 		self.render_progress.Hide()
+	def write_render_trace(self, filename):
+		"""Writes a CSV file listing how many seconds each line of the last render spent in each stage of it's journey through the coagulator and provider, for finding out where the time goes when renders are slow. Lines that were answered from a cache have no trace and are left out."""
+		stages = ["total", "client_network", "coagulator_queue", "provider_network", "provider_queue", "synthesis", "provider_other"]
+		try:
+			with open(filename, "w", newline = "") as f:
+				w = csv.writer(f)
+				w.writerow(["filename"] + stages)
+				for render_filename, sent, received, trace in self.render_traces:
+					times = trace_stages(trace, sent, received)
+					w.writerow([render_filename] + [f"{times[s]:.3f}" if s in times else "" for s in stages])
+		except OSError as e: speech.speak(f"failed to write trace file, {e}")
 	def on_run_local(self, evt):
 		"""If this button is clicked from the connection panel, spin up a local STAR stack and initiate a connection to it."""
 		if self.local:
@@ -599,6 +695,8 @@ class star_client(wx.Frame):
 			config["render_consolidated_silence"] = self.configuration.render_consolidated_silence.Value
 			config["voice_preview_text"] = self.configuration.voice_preview_text.Value
 			config["clear_output_on_render"] = self.configuration.clear_output_on_render.Value
+			config["lossy_audio"] = self.configuration.lossy_audio.Value
+			config["render_trace"] = self.configuration.render_trace.Value
 			old_device = config.get("output_device", None)
 			config["output_device"] = self.configuration.output_device
 			if old_device != config["output_device"]: sound_output.device = playsound_devices.index(config["output_device"]) + 1
@@ -634,6 +732,7 @@ class star_client(wx.Frame):
 		self.speech_requests = {}
 		self.speech_requests_text = {}
 		self.voices = []
+		self.voices_version = 0
 		self.voices_list.update_count(len(self.voices))
 		label_change = self.connecting_label.Label != label
 		self.connecting_label.Label = label
@@ -683,7 +782,7 @@ class star_client(wx.Frame):
 		elif "message" in evt: self.on_remote_message(evt["websocket"], evt["message"])
 	def on_connect(self, websocket):
 		"""This function is fired on every successful websocket connection and is responsible for any UI modifications, server hello, and post-connection-setup required."""
-		websocket.send(json.dumps({"user": USER_REVISION}))
+		websocket.send(json.dumps({"user": USER_REVISION, "voice_deltas": True}))
 		self.websocket = websocket
 		if not self.initial_connection:
 			self.initial_connection = True
@@ -701,7 +800,8 @@ class star_client(wx.Frame):
 		else: meta = {"id": meta}
 		if not "id" in meta: return
 		meta["id"] = meta["id"].partition("_")[2].partition("_")[0]
-		self.on_remote_audio(meta, message[meta_len+2:])
+		if "chunk" in meta: self.on_remote_audio_chunk(meta, message[meta_len+2:])
+		else: self.on_remote_audio(meta, message[meta_len+2:])
 	def on_remote_message(self, websocket, message):
 		"""Handles a parsed json payload received from the remote server."""
 		if "voices" in message:
@@ -724,6 +824,13 @@ class star_client(wx.Frame):
 				try: focused_voice = self.voices_list.find_index_of_item(focused_voice)
 				except ValueError: focused_voice = -1
 			if len(self.voices) > 0 and focused_voice > -1 and self.voices_list.get_selected_index() != focused_voice: self.voices_list.set_selected_index(focused_voice)
+			self.voices_version = message.get("version", 0)
+		elif "voices_added" in message or "voices_removed" in message:
+			if message.get("version") != self.voices_version + 1:
+				# We missed an update, so ask for the full list again.
+				return websocket.send(json.dumps({"user": USER_REVISION, "voice_deltas": True}))
+			self.voices_version = message["version"]
+			self.on_voices_delta(message.get("voices_added", []), message.get("voices_removed", []))
 		elif "error" in message:
 			playsound("audio/error.ogg")
 			speech.speak(message["error"])
@@ -731,20 +838,63 @@ class star_client(wx.Frame):
 			playsound("audio/warning.ogg")
 			speech.speak(message["status"])
 			self.speech_requests_text = {}
-			if "abort" in message and message["abort"] and hasattr(self, "rendered_items"): self.audiosave(None, None)
+			if "abort" in message and message["abort"]:
+				r = self.speech_requests.get(str(message.get("id", "")).partition("_")[2].partition("_")[0])
+				if r and r.stream: r.stream.end() # Let whatever was streamed before the failure finish playing.
+				if hasattr(self, "rendered_items"): self.audiosave(None, None)
 		elif "warning" in message:
 			playsound("audio/warning.ogg")
 			speech.speak(message["warning"])
 			self.speech_requests_text = {}
 			if hasattr(self, "rendered_items"): self.audiosave(None, None)
+	def on_voices_delta(self, added, removed):
+		"""Applies a change to the list of voices sent by the coagulator, removing and appending the given voice names in place so that the virtual voices list keeps focus on the same voice without being rebuilt."""
+		playsound("audio/ready.ogg")
+		focused_voice = self.voices_list.get_selected_index()
+		if removed:
+			removed = set(removed)
+			voices = []
+			for i, v in enumerate(self.voices):
+				if v["name"] not in removed: voices.append(v)
+				elif i < focused_voice: focused_voice -= 1
+			diff = len(self.voices) - len(voices)
+			self.voices = voices
+			playsound("audio/voices_disconnect.ogg")
+			speech.speak(f"{diff} {'voice' if diff == 1 else 'voices'} disconnected.")
+		if added:
+			if len(self.voices) > 0: speech.speak(f"{len(added)} {'voice' if len(added) == 1 else 'voices'} connected!")
+			self.voices += [{"name": v} for v in added]
+			playsound("audio/voices_connect.ogg")
+		self.voices_list.update_count(len(self.voices))
+		focused_voice = min(max(focused_voice, 0), len(self.voices) - 1)
+		if len(self.voices) > 0 and self.voices_list.get_selected_index() != focused_voice: self.voices_list.set_selected_index(focused_voice)
+	def on_remote_audio_chunk(self, meta, audio):
+		"""Handles a piece of audio that a provider is streaming, starting playback of a preview as soon as the first piece arrives. Once the final piece is received, the complete clip is handled by on_remote_audio."""
+		id = meta["id"]
+		if not id in self.speech_requests: return
+		r = self.speech_requests[id]
+		if meta["chunk"] == 0:
+			r.chunks = [] # The coagulator may restart a stream on another provider if the first one fails.
+			if not r.render_filename:
+				if self.current_speech: self.current_speech.close()
+				self.current_speech = r.stream = playstream(finish_func = self.on_done_speaking)
+		r.chunks.append(audio)
+		if r.stream: r.stream.push(audio)
+		if not meta.get("final"): return
+		if r.stream: r.stream.end()
+		self.on_remote_audio({"id": id, "extension": meta.get("extension", "wav"), "trace": meta.get("trace")}, b"".join(r.chunks))
 	def on_remote_audio(self, meta, audio):
 		"""Handles a remote audio payload, speaking it or saving it as a rendered item. Usually called from on_remote_binary. The meta dictionnary is expected to contain at least an id member."""
 		id = meta["id"]
 		ext = meta.get("extension", "wav")
 		if not id in self.speech_requests: return # Rendering was likely canceled.
 		r = self.speech_requests.pop(id)
-		self.speech_cache[r.textline] = {"audio": audio, "extension": ext}
+		if r.render_filename and getattr(self, "render_traces", None) is not None and type(meta.get("trace")) == dict: self.render_traces.append((r.render_filename, r.timestamp, time.time(), meta["trace"]))
+		compressed = ext in r.formats
+		cached = self.speech_cache.get(r.textline)
+		if not compressed or not cached or cached["compressed"]: self.speech_cache[r.textline] = {"audio": audio, "extension": ext, "compressed": compressed} # Never replace audio a render can use with a compressed preview.
 		self.configuration.clear_cache_btn.Enabled = True
+		if r.stream and r.stream.streamable: return # Already playing as it streamed in.
 		if not r.render_filename:
 			if self.current_speech: self.current_speech.close()
 			self.current_speech = playsound(audio, finish_func = self.on_done_speaking)
@@ -772,7 +922,7 @@ class star_client(wx.Frame):
 			self.aliases[voice] = replacement
 	def audiospeak(self, textline, render_filename = None):
 		"""One of the main public interfaces in this application: Receives a parsable line of text "Sam: hello", and either plays the resulting speech synthesis or renders it if a sequence number is given."""
-		if textline in self.speech_cache:
+		if textline in self.speech_cache and not (render_filename and self.speech_cache[textline]["compressed"]): # Compressed preview audio is requested again for renders.
 			if not render_filename:
 				if self.current_speech: self.current_speech.close()
 				self.current_speech = playsound(self.speech_cache[textline]["audio"], finish_func = self.on_done_speaking)
@@ -785,7 +935,11 @@ class star_client(wx.Frame):
 			else: self.speech_requests_text[textline] = time.time()
 			r = speech_request(textline, render_filename)
 			self.speech_requests[r.request_id] = r
-			self.websocket.send(json.dumps({"user": USER_REVISION, "request": textline, "id": r.request_id}))
+			request = {"user": USER_REVISION, "request": textline, "id": r.request_id}
+			if not render_filename: request.update({"priority": 1, "stream": True}) # Previews should not wait behind renders, and can start playing before synthesis completes.
+			formats = [f for f in compressed_audio_formats if f != "opus" or "lossy_audio" in config and config.as_bool("lossy_audio")]
+			if formats and not render_filename: request["formats"] = r.formats = formats[::-1] # Prefer opus when it is allowed at all. Renders are saved as the provider produced them, so that consolidating them doesn't need ffmpeg for flac.
+			self.websocket.send(json.dumps(request))
 	def audiosave(self, filename, audio):
 		"""Saves the contents of a bytes object (intended to be audio data) to the user's output directory, creating the output folder if necessary as well as handling some miscellaneous UI work related to rendering. If filename or audio is not provided, the UI is updated standalone (used for things like render warnings that still need to increase the progress bar)."""
 		if filename and audio: